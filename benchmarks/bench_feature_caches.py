@@ -0,0 +1,44 @@
+"""Compare feature cache build time of the bulk and per-node code paths.
+
+Feature caches are computed while constructing a Rag, so the cache build
+time is estimated by subtracting the construction time without features.
+
+Run from the repository root::
+
+    python benchmarks/bench_feature_caches.py
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+
+import numpy as np
+
+from gala import agglo, features
+from bench_rag_build import supervoxel_volume
+
+
+class LoopMoments(features.moments.Manager):
+    """Moments manager computing each cache separately, as before."""
+    create_node_caches = features.base.Null.create_node_caches
+    create_edge_caches = features.base.Null.create_edge_caches
+
+
+def time_construction(ws, probs, feature_manager, repeats=3):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.time()
+        agglo.Rag(ws, probs, feature_manager=feature_manager)
+        best = min(best, time.time() - start)
+    return best
+
+
+if __name__ == '__main__':
+    ws, probs = supervoxel_volume(nseeds=4000)
+    t_none = time_construction(ws, probs, features.base.Null())
+    t_loop = time_construction(ws, probs, LoopMoments(nmoments=4)) - t_none
+    t_bulk = time_construction(ws, probs,
+                               features.moments.Manager(nmoments=4)) - t_none
+    print('volume %s, %i supervoxels' % (ws.shape, len(np.unique(ws)) - 1))
+    print('per-node loop: %.2fs' % t_loop)
+    print('bulk:          %.2fs' % t_bulk)
+    print('speedup:       %.1fx' % (t_loop / t_bulk))
@@ -0,0 +1,43 @@
+"""Compare graph build time of the vectorized and per-voxel Rag builds.
+
+Run from the repository root::
+
+    python benchmarks/bench_rag_build.py
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+import time
+
+import numpy as np
+from scipy import ndimage as nd
+
+from gala import agglo, morpho
+
+
+def supervoxel_volume(shape=(60, 60, 60), nseeds=400, seed=0):
+    """Watershed a smoothed random volume into roughly `nseeds` regions."""
+    rng = np.random.RandomState(seed)
+    probs = nd.gaussian_filter(rng.rand(*shape), 2)
+    seeds = np.zeros(shape, np.int32)
+    seeds.ravel()[rng.choice(seeds.size, nseeds, replace=False)] = \
+        np.arange(1, nseeds + 1)
+    return morpho.watershed(probs, seeds, dams=True), probs
+
+
+def time_build(ws, probs, vectorized, repeats=1):
+    best = np.inf
+    for _ in range(repeats):
+        start = time.time()
+        agglo.Rag(ws, probs, vectorized_build=vectorized)
+        best = min(best, time.time() - start)
+    return best
+
+
+if __name__ == '__main__':
+    ws, probs = supervoxel_volume()
+    t_loop = time_build(ws, probs, vectorized=False)
+    t_vec = time_build(ws, probs, vectorized=True, repeats=3)
+    print('volume %s, %i supervoxels' % (ws.shape, len(np.unique(ws)) - 1))
+    print('per-voxel loop: %.2fs' % t_loop)
+    print('vectorized:     %.2fs' % t_vec)
+    print('speedup:        %.1fx' % (t_loop / t_vec))
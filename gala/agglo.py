@@ -6,15 +6,17 @@ import argparse
 import random
 import logging
 import json
-from copy import deepcopy
+import multiprocessing
+from copy import copy, deepcopy
 from math import isnan
 # libraries
 from numpy import (array, mean, zeros, zeros_like, uint8, where, unique,
     double, newaxis, nonzero, median, exp, log2, float, ones, arange, inf,
     flatnonzero, sign, unravel_index, bincount)
 import numpy as np
+import h5py
 from scipy.stats import sem
-from scipy.sparse import lil_matrix
+from scipy.sparse import lil_matrix, csr_matrix
 from scipy.misc import comb as nchoosek
 from scipy.ndimage.measurements import label
 from networkx import Graph, biconnected_components
@@ -25,9 +27,13 @@ from viridis import tree
 # local modules
 from . import morpho
 from . import iterprogress as ip
-from . import optimized as opt
 from .ncut import ncutW
-from .mergequeue import MergeQueue
+from .mergequeue import MergeQueue, IndexedMergeQueue
+from .featurecache import FeatureVectorCache
+from .unionfind import UnionFind
+from .rig import Rig
+from . import indexset
+from .indexset import IndexSet, as_array, from_csr, index_dtype
 from .evaluate import contingency_table as ev_contingency_table, split_vi, xlogx
 from . import features
 from . import classify
@@ -38,8 +44,8 @@ from six.moves import range
 from six.moves import zip
 
 
-def contingency_table(a, b):
-    ct = ev_contingency_table(a, b)
+def contingency_table(a, b, *args, **kwargs):
+    ct = ev_contingency_table(a, b, *args, **kwargs)
     nx, ny = ct.shape
     ctout = np.zeros((2 * nx, ny), ct.dtype)
     ct.todense(out=ctout[:nx, :])
@@ -122,20 +128,281 @@ def conditional_countdown(seq, start=1, pred=bool):
         yield remaining
 
 
+# number of voxels processed at once by the vectorized graph build
+_GRAPH_BUILD_CHUNK_SIZE = 2 ** 18
+
+# largest volume, in voxels, for which the neighbors array is precomputed
+# by default
+_NEIGHBOR_ARRAY_MAX_SIZE = 2 ** 24
+
+
+def _boundary_pairs(labels, neighbor_labels, boundary_body,
+                    allow_shared_boundaries=True, nozeros=False):
+    """Find all (edge, voxel) boundary pairs for a set of voxels.
+
+    Parameters
+    ----------
+    labels : array of int, shape (N,)
+        The labels of the voxels being examined.
+    neighbor_labels : array of int, shape (N, K)
+        The labels of the neighbors of each voxel.
+    boundary_body : int
+        The label of the region enveloping the volume.
+    allow_shared_boundaries : bool, optional
+        Whether voxels contributing to more than one edge are kept.
+    nozeros : bool, optional
+        Treat 0 as an ordinary label rather than a boundary.
+
+    Returns
+    -------
+    pos : array of int
+        The position in `labels` of the voxel in each pair.
+    k1, k2 : array of int
+        Keys giving the order of the pairs within a single voxel.
+    l1, l2 : array of int
+        The nodes of the edge in each pair.
+    ignored : array of int
+        Positions of the voxels excluded because they are shared by
+        more than one edge (only when `allow_shared_boundaries` is
+        ``False``).
+    """
+    nb = np.sort(neighbor_labels, axis=1)
+    valid = np.ones(nb.shape, bool)
+    valid[:, 1:] = nb[:, 1:] != nb[:, :-1]
+    valid &= nb != labels[:, newaxis]
+    if nozeros:
+        is_node = np.ones(len(labels), bool)
+    else:
+        valid &= nb != 0
+        is_node = labels != 0
+    # voxels inside a region: one pair per distinct neighboring label
+    rows, cols = np.nonzero(valid & is_node[:, newaxis])
+    pairs = [(rows, nb[rows, cols].astype(np.int64),
+              zeros(len(rows), np.int64), labels[rows], nb[rows, cols])]
+    counts = np.bincount(rows, minlength=max(len(labels), 1))[:len(labels)]
+    # boundary voxels: one pair per pair of neighboring labels, or only
+    # pairs with the boundary body if it is among the neighbors
+    zrows = flatnonzero(~is_node)
+    nbz, validz = nb[zrows], valid[zrows]
+    has_bb = (nbz == boundary_body).any(axis=1)
+    for j1, j2 in combinations(range(nb.shape[1]), 2):
+        m = validz[:, j1] & validz[:, j2] & \
+            (~has_bb | (nbz[:, j2] == boundary_body))
+        r = flatnonzero(m)
+        a, b = nbz[r, j1], nbz[r, j2]
+        pairs.append((zrows[r], a.astype(np.int64), b.astype(np.int64),
+                      np.where(has_bb[r], b, a), np.where(has_bb[r], a, b)))
+        counts[zrows[r]] += 1
+    pos, k1, k2, l1, l2 = list(map(np.concatenate, zip(*pairs)))
+    if allow_shared_boundaries:
+        ignored = np.zeros(0, np.int64)
+    else:
+        ignored = flatnonzero(counts > 1)
+        keep = counts[pos] == 1
+        pos, k1, k2, l1, l2 = pos[keep], k1[keep], k2[keep], \
+                              l1[keep], l2[keep]
+    return pos, k1, k2, l1, l2, ignored
+
+
+def _slab_boundary_pairs(args):
+    """Find the boundary pairs of the voxels in one slab of a volume.
+
+    This is the unit of work of the parallel graph build.
+
+    Parameters
+    ----------
+    args : tuple
+        Contains, in order:
+            - the raveled labels of the slab, with `halo` extra voxels
+              on each side;
+            - `halo`, the number of extra voxels;
+            - the raveled offsets of the neighbors of a voxel;
+            - the remaining arguments to ``_boundary_pairs``.
+
+    Returns
+    -------
+    idxs : array of int
+        The position in the slab (excluding the halo) of the voxel in
+        each pair.
+    k1, k2, l1, l2 : array of int
+        As returned by ``_boundary_pairs``.
+    ignored : array of int
+        The position in the slab of each ignored voxel.
+    """
+    labels, halo, offsets, boundary_body, allow_shared, nozeros = args
+    inner = flatnonzero(labels[halo:len(labels) - halo] != boundary_body)
+    pos, k1, k2, l1, l2, ignored = _boundary_pairs(
+        labels[inner + halo], labels[inner[:, newaxis] + halo + offsets],
+        boundary_body, allow_shared, nozeros)
+    return inner[pos], k1, k2, l1, l2, inner[ignored]
+
+
+def _copy_attributes(attrs):
+    """Copy a node or edge attribute dictionary for the undo log.
+
+    The containers that merges modify in place are copied as well.
+    ``IndexSet`` objects replace their index arrays rather than modify
+    them, so a shallow copy of them is enough.
+    """
+    attrs = dict(attrs)
+    for key in ('watershed_ids', 'exclusions', 'boundary'):
+        if key in attrs:
+            attrs[key] = copy(attrs[key])
+    if 'feature-cache' in attrs:
+        attrs['feature-cache'] = deepcopy(attrs['feature-cache'])
+    return attrs
+
+
+# version of the file layout written by ``Rag.save``
+_RAG_FORMAT_VERSION = 2
+
+# scalar Rag attributes stored by ``Rag.save``
+_RAG_SCALAR_ATTRIBUTES = ['boundary_body', 'volume_size',
+                          'has_zero_boundaries', 'pad_thickness',
+                          'connectivity', 'nozeros', 'boundary_backend',
+                          'merge_queue_type', 'merge_queue_compact_ratio',
+                          'max_merge_score', 'lazy_feature_caches',
+                          'ucm_mode']
+
+
+def _write_csr(group, name, rows, dtype):
+    """Write sets or sequences of int to HDF5 as a CSR-style table.
+
+    Row `i` is stored as ``group[name][ptr[i]:ptr[i+1]]``, with ``ptr``
+    stored as ``group[name + '_ptr']``. Sets are stored sorted.
+    """
+    arrays = [np.sort(as_array(r)) if isinstance(r, (set, frozenset))
+              else as_array(r) for r in rows]
+    ptr = np.concatenate(([0], np.cumsum([len(a) for a in arrays])))
+    group.create_dataset(name + '_ptr', data=ptr.astype(np.int64))
+    data = (np.concatenate(arrays) if len(arrays) > 0 else [])
+    group.create_dataset(name, data=np.asarray(data, dtype))
+
+
+def _read_array(dset, mmap=False):
+    """Read an HDF5 dataset, memory-mapping it if requested and possible.
+
+    Only contiguous, uncompressed datasets can be memory-mapped. The
+    map is copy-on-write: the array can be modified, but the changes
+    are never written to the file.
+    """
+    offset = dset.id.get_offset()
+    if (mmap and offset is not None and dset.chunks is None and
+            dset.compression is None):
+        return np.memmap(dset.file.filename, dset.dtype, 'c', offset,
+                         dset.shape).view(np.ndarray)
+    return dset[()]
+
+
+def _cache_structure(cache):
+    """Split a feature cache into its nesting of lists and its arrays.
+
+    Parameters
+    ----------
+    cache : array or (nested) list of arrays
+        A feature cache, as created by a feature manager.
+
+    Returns
+    -------
+    structure : None or (nested) list of None
+        ``None`` for an array, or a list of the structures of the
+        elements of a list.
+    leaves : list of array
+        The arrays in the cache, in depth-first order.
+
+    Raises
+    ------
+    TypeError
+        If the cache contains anything other than lists and numeric
+        arrays.
+    """
+    if isinstance(cache, np.ndarray) and cache.dtype != object:
+        return None, [cache]
+    if isinstance(cache, list):
+        structure, leaves = [], []
+        for c in cache:
+            s, l = _cache_structure(c)
+            structure.append(s)
+            leaves.extend(l)
+        return structure, leaves
+    raise TypeError('Cannot store feature cache of type %s' % type(cache))
+
+
+def _build_cache(structure, leaves):
+    """Invert ``_cache_structure``, taking arrays from iterator `leaves`."""
+    if structure is None:
+        return next(leaves)
+    return [_build_cache(s, leaves) for s in structure]
+
+
+def _write_feature_caches(group, caches):
+    """Write feature caches to HDF5, with each of their arrays stacked.
+
+    Missing caches (``None``) are recorded as such. The caches are only
+    written if they all have the same structure and array shapes.
+
+    Returns
+    -------
+    written : bool
+        Whether the caches were written.
+    """
+    present = np.array([c is not None for c in caches], bool)
+    group.create_dataset('present', data=present)
+    try:
+        split = [_cache_structure(c) for c in caches if c is not None]
+    except TypeError:
+        return False
+    if len(split) == 0:
+        return False
+    structure, leaves = split[0]
+    shapes = [leaf.shape for leaf in leaves]
+    if any(s != structure or [leaf.shape for leaf in l] != shapes
+           for s, l in split):
+        return False
+    group.attrs['structure'] = json.dumps(structure)
+    group.attrs['num_leaves'] = len(shapes)
+    for k in range(len(shapes)):
+        group.create_dataset('leaf%i' % k,
+                             data=np.array([l[k] for s, l in split]))
+    return True
+
+
+def _read_feature_caches(group):
+    """Read caches written by ``_write_feature_caches``.
+
+    Returns
+    -------
+    caches : list of cache or None, or None
+        The caches, with ``None`` for missing caches, or ``None`` if
+        the caches were not written. Each array of a cache is a view
+        of a row of a single stacked array.
+    """
+    if 'structure' not in group.attrs:
+        return None
+    present = group['present'][()]
+    structure = json.loads(group.attrs['structure'])
+    leaves = [group['leaf%i' % k][()]
+              for k in range(group.attrs['num_leaves'])]
+    caches = [None] * len(present)
+    for row, i in enumerate(flatnonzero(present)):
+        caches[i] = _build_cache(structure, (leaf[row] for leaf in leaves))
+    return caches
+
+
 ############################
 # Merge priority functions #
 ############################
 
 def oriented_boundary_mean(g, n1, n2):
-    return mean(g.oriented_probabilities_r[list(g[n1][n2]['boundary'])])
+    return mean(g.oriented_probabilities_r[as_array(g[n1][n2]['boundary'])])
 
 
 def boundary_mean(g, n1, n2):
-    return mean(g.probabilities_r[list(g[n1][n2]['boundary'])])
+    return mean(g.probabilities_r[as_array(g[n1][n2]['boundary'])])
 
 
 def boundary_median(g, n1, n2):
-    return median(g.probabilities_r[list(g[n1][n2]['boundary'])])
+    return median(g.probabilities_r[as_array(g[n1][n2]['boundary'])])
 
 
 def approximate_boundary_mean(g, n1, n2):
@@ -200,11 +467,49 @@ def mito_merge():
     return predict
 
 
+def batch_priority(batch_function):
+    """Make a merge priority function from one scoring many edges at once.
+
+    Use this as a decorator for custom priority functions that are
+    cheaper to evaluate on many edges together, such as those calling a
+    classifier. ``Rag.merge_priorities`` will then call `batch_function`
+    directly when building the merge queue and after each merge.
+
+    Parameters
+    ----------
+    batch_function : function
+        A function taking a ``Rag`` and a list of edges, and returning
+        an array of merge priorities, one per edge.
+
+    Returns
+    -------
+    predict : function
+        A merge priority function taking a ``Rag`` and two nodes, with
+        `batch_function` as its ``batch`` attribute.
+
+    Examples
+    --------
+    >>> @batch_priority
+    ... def boundary_size(g, edges):
+    ...     return np.array([len(g[u][v]['boundary']) for u, v in edges])
+    >>> ws = np.array([[1, 0, 2], [1, 0, 2]], np.uint32)
+    >>> g = Rag(ws, np.zeros(ws.shape), boundary_size)
+    >>> boundary_size(g, 1, 2)
+    2
+    >>> g.merge_priorities([(1, 2)])
+    array([2])
+    """
+    def predict(g, n1, n2):
+        return batch_function(g, [(n1, n2)])[0]
+    predict.batch = batch_function
+    return predict
+
+
 def classifier_probability(feature_extractor, classifier):
     def predict(g, n1, n2):
         if n1 == g.boundary_body or n2 == g.boundary_body:
             return inf
-        features = feature_extractor(g, n1, n2)
+        features = g.edge_features(feature_extractor, n1, n2)
         try:
             prediction_arr = np.array(classifier.predict_proba(features))
             if prediction_arr.ndim > 2: prediction_arr = prediction_arr[0]
@@ -215,6 +520,25 @@ def classifier_probability(feature_extractor, classifier):
         except AttributeError:
             prediction = classifier.predict(features)[0]
         return prediction
+    def predict_batch(g, edges):
+        predictions = np.full(len(edges), inf)
+        inner = [i for i, (n1, n2) in enumerate(edges)
+                 if g.boundary_body not in (n1, n2)]
+        if len(inner) == 0:
+            return predictions
+        g.materialize_feature_caches([edges[i] for i in inner])
+        features = np.array([g.edge_features(feature_extractor, *edges[i])
+                             for i in inner]).reshape((len(inner), -1))
+        try:
+            prediction_arr = np.array(classifier.predict_proba(features))
+            if prediction_arr.ndim > 2: prediction_arr = prediction_arr[0]
+            if prediction_arr.ndim == 2:
+                prediction_arr = prediction_arr[:, 1]
+        except AttributeError:
+            prediction_arr = classifier.predict(features)
+        predictions[inner] = prediction_arr
+        return predictions
+    predict.batch = predict_batch
     return predict
 
 
@@ -240,6 +564,14 @@ def expected_change_vi(feature_extractor, classifier, alpha=1.0, beta=1.0):
         )
         # Return expected change
         return  (p*alpha*v + (1.0-p)*(-beta*v))
+    def predict_batch(g, edges):
+        p = prob_func.batch(g, edges)
+        v = np.array([compute_local_vi_change(g.node[n1]['size'],
+                                              g.node[n2]['size'],
+                                              g.volume_size)
+                      for n1, n2 in edges])
+        return p*alpha*v + (1.0-p)*(-beta*v)
+    predict.batch = predict_batch
     return predict
 
 
@@ -251,15 +583,57 @@ def compute_local_vi_change(s1, s2, n):
     return -(py1*log2(py1) + py2*log2(py2) - py*log2(py))
 
 
+def _merged_rows(ctable, n1, n2):
+    """Return rows `n1` and `n2` of a contingency table and their sum.
+
+    `ctable` can be an array or a ``Rig``, in which case only the
+    nonzero values of the rows are returned.
+    """
+    if isinstance(ctable, Rig):
+        return (ctable.values(n1), ctable.values(n2),
+                ctable.merged_row(n1, n2)[1])
+    r1, r2 = ctable[n1], ctable[n2]
+    return r1, r2, r1 + r2
+
+
 def compute_true_delta_vi(ctable, n1, n2):
-    p1 = ctable[n1].sum()
-    p2 = ctable[n2].sum()
-    p3 = p1+p2
-    p1g_log_p1g = xlogx(ctable[n1]).sum()
-    p2g_log_p2g = xlogx(ctable[n2]).sum()
-    p3g_log_p3g = xlogx(ctable[n1]+ctable[n2]).sum()
-    return p3*log2(p3) - p1*log2(p1) - p2*log2(p2) - \
-                                2*(p3g_log_p3g - p1g_log_p1g - p2g_log_p2g)
+    return split_vi_delta(*_merged_rows(ctable, n1, n2)).sum()
+
+
+def split_vi_delta(r1, r2, r12=None):
+    """Compute the change in split VI from merging two contingency rows.
+
+    Only the terms of H(Y|X) and H(X|Y) involving the two rows change,
+    so the split VI can be kept up to date during agglomeration in time
+    proportional to the length of the rows.
+
+    Parameters
+    ----------
+    r1, r2 : array of float
+        The rows of a normalized contingency table of the two segments
+        being merged, against the ground truth.
+    r12 : array of float, optional
+        The sum of the rows, ``r1 + r2`` by default. Only the nonzero
+        values of the three rows are needed, in any order, so the rows
+        of a ``Rig`` can be used.
+
+    Returns
+    -------
+    delta : array of float, shape (2,)
+        The change in the false merge and false split terms.
+
+    Examples
+    --------
+    >>> ctable = np.array([[0.25, 0], [0.25, 0.5]])
+    >>> split_vi_delta(ctable[0], ctable[1]) + split_vi(ctable)
+    array([ 1.,  0.])
+    """
+    if r12 is None:
+        r12 = r1 + r2
+    p1, p2 = r1.sum(), r2.sum()
+    dx = xlogx(np.array([p1 + p2, p1, p2], float))
+    dxy = xlogx(r12).sum() - xlogx(r1).sum() - xlogx(r2).sum()
+    return np.array([dx[0] - dx[1] - dx[2] - dxy, -dxy])
 
 
 def expected_change_rand(feature_extractor, classifier, alpha=1.0, beta=1.0):
@@ -270,6 +644,14 @@ def expected_change_rand(feature_extractor, classifier, alpha=1.0, beta=1.0):
             g.node[n1]['size'], g.node[n2]['size'], g.volume_size
         )
         return p*v*alpha + (1.0-p)*(-beta*v)
+    def predict_batch(g, edges):
+        p = prob_func.batch(g, edges)
+        v = np.array([compute_local_rand_change(g.node[n1]['size'],
+                                                g.node[n2]['size'],
+                                                g.volume_size)
+                      for n1, n2 in edges])
+        return p*v*alpha + (1.0-p)*(-beta*v)
+    predict.batch = predict_batch
     return predict
 
 
@@ -281,11 +663,12 @@ def compute_local_rand_change(s1, s2, n):
 def compute_true_delta_rand(ctable, n1, n2, n):
     """Compute change in RI obtained by merging rows n1 and n2.
 
-    This function assumes ctable is normalized to sum to 1.
+    This function assumes ctable is normalized to sum to 1. It can be
+    an array or a ``Rig``.
     """
-    localct = n*ctable[(n1,n2),]
-    delta_sxy = 1.0/2*((localct.sum(axis=0)**2).sum()-(localct**2).sum())
-    delta_sx = 1.0/2*(localct.sum()**2 - (localct.sum(axis=1)**2).sum())
+    r1, r2, r12 = [n * r for r in _merged_rows(ctable, n1, n2)]
+    delta_sxy = 1.0/2*((r12**2).sum() - (r1**2).sum() - (r2**2).sum())
+    delta_sx = r1.sum() * r2.sum()
     return (2*delta_sxy - delta_sx) / nchoosek(n,2)
 
 
@@ -295,7 +678,7 @@ def boundary_mean_ladder(g, n1, n2, threshold, strictness=1):
 
 
 def boundary_mean_plus_sem(g, n1, n2, alpha=-6):
-    bvals = g.probabilities_r[list(g[n1][n2]['boundary'])]
+    bvals = g.probabilities_r[as_array(g[n1][n2]['boundary'])]
     return mean(bvals) + alpha*sem(bvals)
 
 
@@ -312,10 +695,13 @@ class Rag(Graph):
             merge_priority_function=boundary_mean,
             allow_shared_boundaries=True, gt_vol=None,
             feature_manager=features.base.Null(),
-            show_progress=False, lowmem=False, connectivity=1,
+            show_progress=False, lowmem=None, connectivity=1,
             channel_is_oriented=None, orientation_map=array([]),
             normalize_probabilities=False, nozeros=False, exclusions=array([]),
-            isfrozennode=None, isfrozenedge=None):
+            isfrozennode=None, isfrozenedge=None, vectorized_build=True,
+            boundary_backend='set', merge_queue_type='lazy',
+            merge_queue_compact_ratio=None, cache_feature_vectors=True,
+            n_jobs=1, lazy_feature_caches=False, ucm_mode='eager'):
         """Create a graph from label and image/probability volumes.
 
         The label field can be complete (every pixel belongs to a
@@ -351,10 +737,14 @@ class Rag(Graph):
         show_progress : bool, optional
             Whether to display an ASCII progress bar during long-
             -running graph operations.
-        lowmem : bool, optional
+        lowmem : bool or 'strides', optional
             Use a lower-memory mode by not pre-caching the neighbors
             array. This trades off a 10% decrease in memory usage
-            for a 10% slower runtime.
+            for a 10% slower runtime. With ``'strides'``, neighbors are
+            instead found by adding precomputed offsets to the voxel
+            indices, which uses no extra memory and is about as fast as
+            the neighbors array. By default, ``'strides'`` is used for
+            volumes larger than 2**24 voxels. See ``set_watershed``.
         connectivity : int in {1, ..., `watershed.ndim`}
             When determining adjacency, allow neighbors along
             `connectivity` dimensions.
@@ -386,6 +776,47 @@ class Rag(Graph):
         isfrozenedge : function, optional
             As `isfrozennode`, but the function should take the graph
             and *two* nodes, to specify an edge that cannot be merged.
+        vectorized_build : bool, optional
+            Build the graph using bulk NumPy operations instead of a
+            per-voxel loop. This is much faster and produces the same
+            graph.
+        boundary_backend : {'set', 'array'}, optional
+            How edge boundaries and node extents are stored. ``'set'``
+            uses Python sets of ints. ``'array'`` uses ``IndexSet``
+            objects, sorted arrays of indices that initially share a
+            single CSR-style edge-to-voxel table, using about 10 times
+            less memory. See ``Rag.boundary_nbytes``.
+        merge_queue_type : {'lazy', 'indexed'}, optional
+            The merge queue implementation. ``'lazy'`` marks stale
+            queue items as invalid and leaves them in the heap, while
+            ``'indexed'`` removes or moves them in place, keeping only
+            one item per edge in the heap. Both merge in the same order.
+        merge_queue_compact_ratio : float, optional
+            For the lazy queue, remove invalid items from the heap
+            whenever it grows to this many times the number of valid
+            items. By default, the heap is never compacted.
+        cache_feature_vectors : bool, optional
+            Keep the edge feature vectors computed by feature managers
+            until one of the edge's nodes is merged. See
+            ``Rag.edge_features``.
+        n_jobs : int, optional
+            Build the graph using this many processes, each finding the
+            boundaries within one slab of the volume. The graph is the
+            same as with a single process. Only used with
+            `vectorized_build`.
+        lazy_feature_caches : bool, optional
+            Do not compute the node and edge feature caches up front.
+            Instead, each cache is created the first time the feature
+            manager computes features from it, and merging two nodes or
+            edges without caches only merges their voxels. In volumes
+            with 0-labeled boundaries, merged nodes always have a cache.
+        ucm_mode : {'eager', 'deferred', 'off'}, optional
+            How the ultrametric contour map (UCM) is maintained.
+            ``'eager'`` writes the merge score to the boundary voxels
+            of each merged edge. ``'deferred'`` only records the merged
+            boundaries and their scores, and paints them all at once
+            when the UCM is requested with ``get_ucm``. ``'off'`` does
+            not keep a UCM at all.
 
         Returns
         -------
@@ -395,6 +826,17 @@ class Rag(Graph):
             segmentation.
         """
         super(Rag, self).__init__(weighted=False)
+        if boundary_backend not in ('set', 'array'):
+            raise ValueError('Unknown boundary backend: %s' % boundary_backend)
+        self.boundary_backend = boundary_backend
+        if merge_queue_type not in ('lazy', 'indexed'):
+            raise ValueError('Unknown merge queue type: %s' % merge_queue_type)
+        self.merge_queue_type = merge_queue_type
+        self.merge_queue_compact_ratio = merge_queue_compact_ratio
+        if ucm_mode not in ('eager', 'deferred', 'off'):
+            raise ValueError('Unknown UCM mode: %s' % ucm_mode)
+        self.ucm_mode = ucm_mode
+        self.ucm_log = []
         self.show_progress = show_progress
         self.nozeros = nozeros
         self.connectivity = connectivity
@@ -403,7 +845,7 @@ class Rag(Graph):
         self.set_watershed(watershed, lowmem, connectivity)
         self.set_probabilities(probabilities, normalize_probabilities)
         self.set_orientations(orientation_map, channel_is_oriented)
-        if watershed is None:
+        if watershed is None or ucm_mode == 'off':
             self.ucm = None
         else:
             self.ucm = -inf*ones(self.watershed.shape, dtype=float)
@@ -412,12 +854,23 @@ class Rag(Graph):
         self.merge_priority_function = merge_priority_function
         self.max_merge_score = -inf
         self.build_graph_from_watershed(allow_shared_boundaries,
-                                        nozerosfast=self.nozeros)
+                                        nozerosfast=self.nozeros,
+                                        vectorized=vectorized_build,
+                                        n_jobs=n_jobs)
+        self.feature_vector_cache = (FeatureVectorCache()
+                                     if cache_feature_vectors else None)
+        self.lazy_feature_caches = lazy_feature_caches
         self.set_feature_manager(feature_manager)
         self.set_ground_truth(gt_vol)
         self.set_exclusions(exclusions)
-        self.merge_queue = MergeQueue()
+        self.merge_queue = self._new_merge_queue()
+        self.dirty_edges = None
+        self.undo_log = None
+        self.open_snapshots = []
+        self.transactions = []
+        self.build_extent_index()
         self.tree = tree.Ultrametric(self.nodes())
+        self.segment_map = UnionFind(self.nodes())
         self.frozen_nodes = set()
         if isfrozennode is not None:
             for node in self.nodes():
@@ -438,8 +891,12 @@ class Rag(Graph):
         pr_shape = self.probabilities_r.shape
         g = super(Rag, self).copy()
         g.watershed_r = g.watershed.ravel()
-        g.ucm_r = g.ucm.ravel()
+        if g.ucm is not None:
+            g.ucm_r = g.ucm.ravel()
         g.probabilities_r = g.probabilities.reshape(pr_shape)
+        if self.feature_vector_cache is not None:
+            # the cached vectors remain valid for the original feature map
+            g.feature_vector_cache.owner = self.feature_vector_cache.owner
         return g
 
 
@@ -449,18 +906,483 @@ class Rag(Graph):
         return self.__copy__()
 
 
+    def snapshot(self):
+        """Start recording changes, so that they can be undone by ``restore``.
+
+        While a snapshot is open, ``merge_nodes`` records the nodes and
+        edges it is about to change, and merge queue rebuilds record
+        the queue they replace. Restoring a snapshot replays these
+        records backwards, taking time proportional to the work done
+        since the snapshot, rather than copying the whole graph.
+
+        Snapshots can be nested.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        snapshot : int
+            A marker to pass to ``restore`` or ``release``.
+
+        Examples
+        --------
+        >>> ws = np.array([[1, 1, 2, 3]])
+        >>> g = Rag(ws, np.array([[0.0, 0.0, 0.5, 0.1]]))
+        >>> s = g.snapshot()
+        >>> g.agglomerate(np.inf)
+        >>> g.number_of_nodes()
+        2
+        >>> g.restore(s)
+        >>> g.number_of_nodes()
+        4
+        """
+        if self.undo_log is None:
+            self.undo_log = []
+        self.open_snapshots.append(len(self.undo_log))
+        return self.open_snapshots[-1]
+
+
+    def restore(self, snapshot):
+        """Undo all merges made since `snapshot` was taken, and close it.
+
+        The nodes, edges, feature caches, UCM, merge tree and merge
+        queue return to their state at the time of the snapshot. Any
+        snapshots taken after `snapshot` are closed too.
+
+        Parameters
+        ----------
+        snapshot : int
+            A marker returned by ``snapshot``.
+
+        Returns
+        -------
+        None
+        """
+        self._close_snapshot(snapshot)
+        while len(self.undo_log) > snapshot:
+            kind, record = self.undo_log.pop()
+            getattr(self, '_undo_' + kind)(record)
+        if len(self.open_snapshots) == 0:
+            self.undo_log = None
+
+
+    def release(self, snapshot):
+        """Close `snapshot`, keeping the changes made since it was taken.
+
+        Parameters
+        ----------
+        snapshot : int
+            A marker returned by ``snapshot``.
+
+        Returns
+        -------
+        None
+        """
+        self._close_snapshot(snapshot)
+        if len(self.open_snapshots) == 0:
+            self.undo_log = None
+
+
+    def _close_snapshot(self, snapshot):
+        """Remove `snapshot`, and any taken after it, from the open list."""
+        if snapshot not in self.open_snapshots:
+            raise ValueError('Snapshot %r is not open' % (snapshot,))
+        i = len(self.open_snapshots) - 1 - \
+            self.open_snapshots[::-1].index(snapshot)
+        del self.open_snapshots[i:]
+
+
+    def begin(self):
+        """Start a transaction, to be ended by ``commit`` or ``rollback``.
+
+        Transactions are snapshots (see ``Rag.snapshot``) ended in
+        last-in, first-out order. They can be used to score tentative
+        merges: merge the nodes, read the new priorities of the edges
+        of the merged node, and roll back.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Examples
+        --------
+        >>> ws = np.array([[1, 1, 2],
+        ...                [3, 3, 3]])
+        >>> g = Rag(ws, np.array([[0.0, 0.2, 0.4],
+        ...                       [0.6, 0.8, 1.0]]))
+        >>> g.begin()
+        >>> n = g.merge_nodes(1, 2)
+        >>> print(round(g.merge_priority_function(g, n, 3), 2))
+        0.5
+        >>> g.rollback()
+        >>> print(round(g.merge_priority_function(g, 2, 3), 2))
+        0.7
+        """
+        self.transactions.append(self.snapshot())
+
+
+    def commit(self):
+        """End the innermost transaction, keeping its changes.
+
+        Changes made in a transaction nested in another one can still
+        be undone by rolling back the outer transaction.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        self.release(self._end_transaction())
+
+
+    def rollback(self):
+        """End the innermost transaction, undoing its changes.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        self.restore(self._end_transaction())
+
+
+    def _end_transaction(self):
+        """Remove and return the snapshot of the innermost transaction."""
+        if len(getattr(self, 'transactions', [])) == 0:
+            raise ValueError('No transaction in progress')
+        return self.transactions.pop()
+
+
+    def save(self, fn):
+        """Write the graph to an HDF5 file, to be read by ``Rag.load``.
+
+        The file contains the padded volumes, the RIG, the nodes and
+        edges with their attributes, the feature caches, and the merge
+        tree. Sets
+        of voxel indices, such as edge boundaries, are concatenated
+        into CSR-style arrays, and feature caches are stacked into one
+        array per cache component, so that loading takes time
+        proportional to the file size.
+
+        Merge priority functions and feature managers are not stored;
+        pass them to ``Rag.load``. Feature caches are only stored if
+        they consist of numeric arrays of the same shapes for every
+        node (or edge). The merge queue is not stored.
+
+        Parameters
+        ----------
+        fn : string
+            The file name.
+
+        Returns
+        -------
+        None
+        """
+        nodes, edges = self.nodes(), self.edges()
+        dtype = index_dtype(self.watershed.size)
+        with h5py.File(fn, 'w') as f:
+            f.attrs['format_version'] = _RAG_FORMAT_VERSION
+            for name in _RAG_SCALAR_ATTRIBUTES:
+                if getattr(self, name, None) is not None:
+                    f.attrs[name] = getattr(self, name)
+            f.attrs['cache_feature_vectors'] = \
+                                        self.feature_vector_cache is not None
+            f.attrs['feature_manager'] = json.dumps(
+                                        self.feature_manager.write_fm({}))
+            volumes = {'watershed': self.watershed,
+                       'probabilities': self.probabilities,
+                       'ucm': self._painted_ucm(),
+                       'orientation_map': self.orientation_map,
+                       'channel_is_oriented': self.channel_is_oriented,
+                       'gt': self.gt,
+                       'ignored_boundary': getattr(self, 'ignored_boundary',
+                                                   None),
+                       'extent_order': self.extent_order,
+                       'extent_ptr': self.extent_ptr}
+            for name, volume in volumes.items():
+                if volume is not None:
+                    f.create_dataset('volumes/' + name, data=volume)
+            rig = self.rig.tocsr()
+            group = f.create_group('rig')
+            group.attrs['shape'] = rig.shape
+            for name in ['data', 'indices', 'indptr']:
+                group.create_dataset(name, data=getattr(rig, name))
+            group = f.create_group('nodes')
+            group.create_dataset('ids', data=np.array(nodes, np.int64))
+            group.create_dataset('size', data=np.array(
+                [self.node[n].get('size', -1) for n in nodes], np.int64))
+            has_ids = [('watershed_ids' in self.node[n]) for n in nodes]
+            group.create_dataset('has_watershed_ids', data=has_ids)
+            _write_csr(group, 'watershed_ids',
+                       [self.node[n].get('watershed_ids', []) for n in nodes],
+                       np.int64)
+            _write_csr(group, 'exclusions',
+                       [self.node[n]['exclusions'] for n in nodes], np.int64)
+            entrypoints = [self.node[n].get('entrypoint') for n in nodes]
+            group.create_dataset('has_entrypoint',
+                                 data=[e is not None for e in entrypoints])
+            group.create_dataset('entrypoint', data=np.array(
+                    [zeros(self.watershed.ndim, int) if e is None else e
+                     for e in entrypoints], np.int64).reshape(
+                                                (-1, self.watershed.ndim)))
+            _write_feature_caches(group.create_group('feature_caches'),
+                    [self.node[n].get('feature-cache') for n in nodes])
+            group = f.create_group('edges')
+            group.create_dataset('ids', data=np.array(edges, np.int64
+                                                      ).reshape((-1, 2)))
+            _write_csr(group, 'boundary',
+                       [self[u][v]['boundary'] for u, v in edges], dtype)
+            group.create_dataset('weight', data=np.array(
+                [self[u][v].get('weight', np.nan) for u, v in edges], float))
+            _write_feature_caches(group.create_group('feature_caches'),
+                    [self[u][v].get('feature-cache') for u, v in edges])
+            group = f.create_group('frozen')
+            group.create_dataset('nodes', data=np.array(
+                        list(self.frozen_nodes), np.int64))
+            group.create_dataset('edges', data=np.array(
+                        list(self.frozen_edges), np.int64).reshape((-1, 2)))
+            group = f.create_group('tree')
+            tree_nodes = self.tree.nodes()
+            group.create_dataset('ids', data=np.array(tree_nodes, np.int64))
+            group.create_dataset('w', data=np.array(
+                [self.tree.node[n]['w'] for n in tree_nodes], float))
+            group.create_dataset('num_leaves', data=np.array(
+                [self.tree.node[n]['num_leaves'] for n in tree_nodes],
+                np.int64))
+            group.create_dataset('edges', data=np.array(
+                self.tree.edges(), np.int64).reshape((-1, 2)))
+            group.attrs['maxw'] = self.tree.maxw
+            # there is no way to peek at an itertools.count
+            next_id = next(self.tree.id_counter)
+            self.tree.id_counter = it.count(next_id)
+            group.attrs['next_id'] = next_id
+
+
+    @classmethod
+    def load(cls, fn, merge_priority_function=boundary_mean,
+             feature_manager=None, lowmem=None, mmap=True,
+             show_progress=False):
+        """Read a graph written by ``Rag.save``.
+
+        Parameters
+        ----------
+        fn : string
+            The file name.
+        merge_priority_function : callable function, optional
+            As in ``Rag.__init__``.
+        feature_manager : ``features.base.Null`` object, optional
+            The feature manager of the graph. The stored feature caches
+            are used if this manager has the same configuration as the
+            one that created them (see ``write_fm``); otherwise, they
+            are recomputed. If not given, a ``Null`` manager is used.
+        lowmem : bool or 'strides', optional
+            How to find the neighbors of voxels. See ``set_watershed``.
+        mmap : bool, optional
+            Memory-map the volumes and the edge boundaries, rather than
+            reading them into memory. Changes made to these arrays, for
+            example to the UCM during agglomeration, are not written
+            back to the file.
+        show_progress : bool, optional
+            As in ``Rag.__init__``.
+
+        Returns
+        -------
+        g : Rag object
+            The graph, with an empty merge queue.
+        """
+        g = cls.__new__(cls)
+        super(Rag, g).__init__(weighted=False)
+        with h5py.File(fn, 'r') as f:
+            if f.attrs['format_version'] > _RAG_FORMAT_VERSION:
+                raise ValueError('Unsupported Rag file format version: %i'
+                                 % f.attrs['format_version'])
+            for name in _RAG_SCALAR_ATTRIBUTES:
+                value = f.attrs.get(name)
+                if isinstance(value, np.generic):
+                    value = value.item()
+                elif isinstance(value, bytes):
+                    value = value.decode()
+                setattr(g, name, value)
+            volumes = dict((name, _read_array(dset, mmap))
+                           for name, dset in f['volumes'].items())
+            if 'rig' in f:
+                group = f['rig']
+                rig = csr_matrix(tuple(group[name][()] for name in
+                                       ['data', 'indices', 'indptr']),
+                                 shape=tuple(group.attrs['shape']))
+            else:
+                # version 1 files store the RIG as a dense volume
+                rig = volumes['rig'].reshape((len(volumes['rig']), -1))
+            group = f['nodes']
+            nodes = group['ids'][()].tolist()
+            sizes = group['size'][()].tolist()
+            has_ids = group['has_watershed_ids'][()]
+            ids_ptr = group['watershed_ids_ptr'][()]
+            ids = group['watershed_ids'][()].tolist()
+            excl_ptr = group['exclusions_ptr'][()]
+            excl = group['exclusions'][()].tolist()
+            has_entrypoint = group['has_entrypoint'][()]
+            entrypoints = group['entrypoint'][()]
+            node_caches = _read_feature_caches(group['feature_caches'])
+            group = f['edges']
+            edges = group['ids'][()].tolist()
+            boundary_ptr = group['boundary_ptr'][()]
+            boundary = _read_array(group['boundary'], mmap)
+            weights = group['weight'][()]
+            edge_caches = _read_feature_caches(group['feature_caches'])
+            frozen_nodes = f['frozen/nodes'][()].tolist()
+            frozen_edges = f['frozen/edges'][()].tolist()
+            group = f['tree']
+            tree_nodes = group['ids'][()].tolist()
+            tree_ws = group['w'][()].tolist()
+            tree_num_leaves = group['num_leaves'][()].tolist()
+            tree_edges = group['edges'][()].tolist()
+            maxw, next_id = group.attrs['maxw'], group.attrs['next_id']
+            cache_feature_vectors = f.attrs['cache_feature_vectors']
+            stored_fm = f.attrs['feature_manager']
+        g.show_progress = show_progress
+        g.pbar = (ip.StandardProgressBar() if show_progress
+                  else ip.NoProgressBar())
+        g.watershed = volumes['watershed']
+        g.watershed_r = g.watershed.ravel()
+        g._set_neighbor_idxs(lowmem, g.connectivity)
+        g.probabilities = volumes['probabilities']
+        g.probabilities_r = g.probabilities.reshape((g.watershed.size, -1))
+        g.orientation_map = volumes['orientation_map']
+        g.orientation_map_r = g.orientation_map.ravel()
+        channel_is_oriented = volumes['channel_is_oriented']
+        g._set_oriented_probabilities(channel_is_oriented
+                                      if channel_is_oriented.any() else None)
+        if g.ucm_mode is None:
+            g.ucm_mode = 'eager'
+        g.ucm_log = []
+        g.ucm = volumes.get('ucm')
+        if g.ucm is not None:
+            g.ucm_r = g.ucm.ravel()
+        g.gt = volumes.get('gt')
+        g.rig = Rig(rig)
+        g.rig_split_vi = g.rig.split_vi() if g.gt is not None else None
+        if 'ignored_boundary' in volumes:
+            g.ignored_boundary = volumes['ignored_boundary']
+        g.extent_order = volumes['extent_order']
+        g.extent_ptr = volumes['extent_ptr']
+        g.merge_priority_function = merge_priority_function
+        for i, n in enumerate(nodes):
+            attrs = {'exclusions': set(excl[excl_ptr[i]:excl_ptr[i+1]])}
+            if sizes[i] >= 0:
+                attrs['size'] = sizes[i]
+            if has_ids[i]:
+                attrs['watershed_ids'] = ids[ids_ptr[i]:ids_ptr[i+1]]
+            if has_entrypoint[i]:
+                attrs['entrypoint'] = entrypoints[i]
+            g.add_node(n, attr_dict=attrs)
+        if g.boundary_backend == 'array':
+            boundaries = from_csr(boundary_ptr, boundary)
+        else:
+            boundaries = [set(boundary[start:stop].tolist()) for start, stop
+                          in zip(boundary_ptr[:-1], boundary_ptr[1:])]
+        for (u, v), b, w in zip(edges, boundaries, weights):
+            g.add_edge(u, v, boundary=b)
+            if not isnan(w):
+                g[u][v]['weight'] = w
+        g.feature_vector_cache = (FeatureVectorCache()
+                                  if cache_feature_vectors else None)
+        if feature_manager is None:
+            feature_manager = features.base.Null()
+        if (stored_fm == json.dumps(feature_manager.write_fm({})) and
+                node_caches is not None and edge_caches is not None):
+            g.feature_manager = feature_manager
+            for n, cache in zip(nodes, node_caches):
+                if cache is not None:
+                    g.node[n]['feature-cache'] = cache
+            for (u, v), cache in zip(edges, edge_caches):
+                if cache is not None:
+                    g[u][v]['feature-cache'] = cache
+        else:
+            g.set_feature_manager(feature_manager)
+        g.merge_queue = g._new_merge_queue()
+        g.dirty_edges = None
+        g.undo_log = None
+        g.open_snapshots = []
+        g.transactions = []
+        g.tree = tree.Ultrametric()
+        g.tree.add_nodes_from((n, {'w': w, 'num_leaves': k}) for n, w, k
+                              in zip(tree_nodes, tree_ws, tree_num_leaves))
+        g.tree.add_edges_from(tree_edges)
+        g.tree.maxw = maxw
+        g.tree.id_counter = it.count(next_id)
+        parents = set(u for u, v in tree_edges)
+        g.segment_map = UnionFind(n for n in tree_nodes if n not in parents)
+        g.segment_map.assign((n, g.node[n].get('watershed_ids', [n]))
+                             for n in nodes)
+        g.frozen_nodes = set(frozen_nodes)
+        g.frozen_edges = set(map(tuple, frozen_edges))
+        return g
+
+
     def extent(self, nodeid):
+        """Return the raveled indices of the voxels belonging to a node.
+
+        Parameters
+        ----------
+        nodeid : int
+            The node.
+
+        Returns
+        -------
+        extent : set or array of int
+            The linear indices into ``self.watershed_r`` of the node's
+            voxels. During graph construction, this is the extent
+            stored on the node; afterwards, it is an array gathered from
+            the supervoxel index built by ``Rag.build_extent_index``, in
+            time linear in the size of the node.
+        """
         if 'extent' in self.node[nodeid]:
             return self.node[nodeid]['extent']
-        extent_array = opt.flood_fill(self.watershed, 
-                                      np.array(self.node[nodeid]['entrypoint']), 
-                                      np.array(self.node[nodeid]['watershed_ids']))
-        if len(extent_array) != self.node[nodeid]['size']:
-            sys.stderr.write("Flood fill fail - found %d voxels but size expected %d\n" \
-                                % (len(extent_array), self.node[nodeid]['size']))
-        raveled_indices = np.ravel_multi_index((extent_array[:,0], 
-                extent_array[:,1], extent_array[:,2]), self.watershed.shape)
-        return set(raveled_indices)
+        ids = np.asarray(self.node[nodeid].get('watershed_ids', [nodeid]),
+                         np.intp)
+        starts = self.extent_ptr[ids]
+        lengths = self.extent_ptr[ids + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = (np.arange(lengths.sum()) +
+                     np.repeat(starts - offsets, lengths))
+        return self.extent_order[positions]
+
+
+    def build_extent_index(self):
+        """Index the voxels of each supervoxel, for use by ``Rag.extent``.
+
+        The voxel indices of the volume are sorted by supervoxel label
+        into ``self.extent_order``, so that the voxels of supervoxel `i`
+        are ``self.extent_order[self.extent_ptr[i]:self.extent_ptr[i+1]]``.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+        """
+        labels = self.watershed_r.astype(np.intp)
+        self.extent_order = np.argsort(labels, kind='mergesort').astype(
+                                        index_dtype(labels.size), copy=False)
+        counts = np.bincount(labels) if labels.size > 0 else []
+        self.extent_ptr = np.concatenate(([0], np.cumsum(counts))).astype(
+                                                                np.intp)
+
 
     def real_edges(self, *args, **kwargs):
         """Return edges internal to the volume.
@@ -564,10 +1486,32 @@ class Rag(Graph):
                         self[l1][l2]['boundary'].add(idx)
                     else:
                         self.add_edge(l1, l2, boundary=set([idx]))
+        self._convert_index_sets()
+
+
+    def _convert_index_sets(self):
+        """Convert set boundaries and extents to the configured backend."""
+        if self.boundary_backend != 'array':
+            return
+        dtype = index_dtype(self.watershed.size)
+        for n, d in self.nodes_iter(data=True):
+            if type(d.get('extent')) == set:
+                d['extent'] = IndexSet(d['extent'], dtype)
+        for u, v, d in self.edges_iter(data=True):
+            if type(d['boundary']) == set:
+                d['boundary'] = IndexSet(d['boundary'], dtype)
+
+
+    def _new_index_set(self, idxs=()):
+        """Return a boundary or extent container for the current backend."""
+        if self.boundary_backend == 'array':
+            return IndexSet(as_array(idxs), index_dtype(self.watershed.size))
+        return set(idxs)
 
 
     def build_graph_from_watershed(self, allow_shared_boundaries=True,
-                                   idxs=None, nozerosfast=False):
+                                   idxs=None, nozerosfast=False,
+                                   vectorized=True, n_jobs=1):
         """Build the graph object from the region labels.
 
         The region labels should have been set ahead of time using
@@ -585,11 +1529,24 @@ class Rag(Graph):
             Assume that there are no zero (boundary) labels in the
             volume. By removing this check, graph build time is
             reduced.
+        vectorized : bool, optional
+            Compute the graph with bulk NumPy operations rather than a
+            per-voxel Python loop. The resulting graph is the same.
+        n_jobs : int, optional
+            Number of processes used by the vectorized build.
 
         Returns
         -------
         None
+
+        See Also
+        --------
+        ``build_graph_from_watershed_vectorized``
         """
+        if vectorized:
+            self.build_graph_from_watershed_vectorized(
+                allow_shared_boundaries, idxs, nozerosfast, n_jobs)
+            return
         if nozerosfast:
             self.build_graph_from_watershed_nozerosfast(idxs)
             return
@@ -640,11 +1597,222 @@ class Rag(Graph):
                         self.add_edge(l1, l2, boundary=set([idx]))
             elif len(edges) > 1:
                 self.ignored_boundary.ravel()[idx] = True
+        self._convert_index_sets()
+
+
+    def build_graph_from_watershed_vectorized(self,
+                                              allow_shared_boundaries=True,
+                                              idxs=None, nozerosfast=False,
+                                              n_jobs=1):
+        """Build the graph object from the region labels, using NumPy.
+
+        This produces the same graph as the per-voxel loop in
+        ``build_graph_from_watershed``, including node and edge insertion
+        order, but computes all (label, neighbor label, voxel) triplets
+        in bulk, a chunk of voxels at a time.
+
+        Parameters
+        ----------
+        allow_shared_boundaries : bool, optional
+            Allow voxels that have three or more distinct neighboring
+            labels to be included in all boundaries.
+        idxs : array-like of int, optional
+            Linear indices into raveled volume array. If provided, the
+            graph is built only for these indices.
+        nozerosfast : bool, optional
+            Assume that there are no zero (boundary) labels in the
+            volume. Shared boundaries are then always allowed.
+        n_jobs : int, optional
+            When building the whole graph, split the volume into slabs
+            and find their boundaries in this many processes.
+
+        Returns
+        -------
+        None
+        """
+        if self.watershed.size == 0: return # stop processing for empty graphs
+        if nozerosfast:
+            allow_shared_boundaries = True
+        elif not allow_shared_boundaries:
+            self.ignored_boundary = zeros(self.watershed.shape, bool)
+        as_index_sets = self.boundary_backend == 'array'
+        dtype = index_dtype(self.watershed.size)
+        parallel = n_jobs > 1 and idxs is None
+        if idxs is None:
+            idxs = arange(self.watershed.size)
+            bb_extent = flatnonzero(self.watershed==self.boundary_body)
+            self.add_node(self.boundary_body, extent=(
+                IndexSet(bb_extent, dtype, is_sorted=True) if as_index_sets
+                else set(bb_extent)))
+        idxs = np.asarray(idxs)
+        # indices are sorted within each node/edge if idxs is sorted
+        is_sorted = bool((np.diff(idxs) > 0).all())
+        inner_idxs = idxs[self.watershed_r[idxs] != self.boundary_body]
+        labels = self.watershed_r[inner_idxs]
+
+        # voxel -> node statistics, in order of first appearance
+        if nozerosfast:
+            node_pos = arange(len(labels))
+        else:
+            node_pos = flatnonzero(labels)
+        order = node_pos[np.argsort(labels[node_pos], kind='mergesort')]
+        node_ids, starts = np.unique(labels[order], return_index=True)
+        counts = np.diff(np.append(starts, len(order)))
+        first_pos = order[starts]
+        if as_index_sets:
+            extents = from_csr(np.append(starts, len(order)),
+                               inner_idxs[order].astype(dtype))
+            if not is_sorted:
+                extents = [IndexSet(e.indices) for e in extents]
+        else:
+            extents = [e.tolist() for e in
+                       np.split(inner_idxs[order], starts[1:])]
+
+        # (pos, k1, k2, l1, l2) for every boundary voxel of every edge
+        chunks = []
+        starts_chunk = range(0, len(inner_idxs), _GRAPH_BUILD_CHUNK_SIZE)
+        if parallel:
+            chunks = self._parallel_boundary_pairs(inner_idxs,
+                        allow_shared_boundaries, nozerosfast, n_jobs)
+            starts_chunk = []
+        for start in ip.with_progress(starts_chunk, title='Graph ',
+                                      pbar=self.pbar):
+            chunk = inner_idxs[start:start + _GRAPH_BUILD_CHUNK_SIZE]
+            pos, k1, k2, l1, l2, ignored = _boundary_pairs(
+                labels[start:start + len(chunk)],
+                self.watershed_r[self.neighbor_idxs(chunk)],
+                self.boundary_body, allow_shared_boundaries, nozerosfast)
+            chunks.append((pos + start, k1, k2, l1, l2))
+            if len(ignored) > 0:
+                self.ignored_boundary.ravel()[chunk[ignored]] = True
+        if len(chunks) > 0:
+            pos, k1, k2, l1, l2 = list(map(np.concatenate, zip(*chunks)))
+        else:
+            pos, k1, k2, l1, l2 = [np.zeros(0, np.int64)] * 5
+            l1 = l2 = l1.astype(labels.dtype)
+        order = np.lexsort((k2, k1, pos))
+        pos, k1, k2, l1, l2 = pos[order], k1[order], k2[order], \
+                              l1[order], l2[order]
+
+        # nodes are created in the order they are first mentioned: either
+        # as the label of a voxel or as an endpoint of a new edge
+        npairs = len(pos)
+        mention_pos = np.concatenate((first_pos, pos, pos))
+        mention_k1 = np.concatenate((-ones(len(first_pos), np.int64), k1, k1))
+        mention_k2 = np.concatenate((-ones(len(first_pos), np.int64), k2, k2))
+        mention_end = np.concatenate((zeros(len(first_pos), np.int64),
+                                      ones(npairs, np.int64),
+                                      2 * ones(npairs, np.int64)))
+        mention_node = np.concatenate((node_ids, l1, l2))
+        order = np.lexsort((mention_end, mention_k2, mention_k1, mention_pos))
+        mentioned, first = np.unique(mention_node[order], return_index=True)
+        for n in mentioned[np.argsort(first)]:
+            if not self.has_node(n):
+                self.add_node(n)
+        for n, p, size, extent in zip(node_ids, first_pos, counts, extents):
+            attrs = self.node[n]
+            if 'entrypoint' not in attrs:
+                entrypoint_tuple = np.unravel_index(inner_idxs[p],
+                                                    self.watershed.shape)
+                attrs['entrypoint'] = np.array(entrypoint_tuple)
+            if 'watershed_ids' not in attrs:
+                attrs['watershed_ids'] = [n]
+            if 'extent' in attrs:
+                attrs['extent'].update(extent)
+            elif as_index_sets:
+                attrs['extent'] = extent
+            else:
+                attrs['extent'] = set(extent)
+            attrs['size'] = attrs.get('size', 0) + int(size)
+
+        # edges are created in the order of their first boundary voxel
+        u, v = np.minimum(l1, l2), np.maximum(l1, l2)
+        ekeys = u.astype(np.int64) * (int(self.boundary_body) + 1) + v
+        _, first = np.unique(ekeys, return_index=True)
+        first = np.sort(first)
+        order = np.argsort(ekeys, kind='mergesort')
+        _, group_starts = np.unique(ekeys[order], return_index=True)
+        if as_index_sets:
+            boundaries = from_csr(np.append(group_starts, len(order)),
+                                  inner_idxs[pos[order]].astype(dtype))
+            if not is_sorted:
+                boundaries = [IndexSet(b.indices) for b in boundaries]
+        else:
+            boundaries = [b.tolist() for b in
+                          np.split(inner_idxs[pos[order]], group_starts[1:])]
+        boundaries = dict(zip(ekeys[order[group_starts]], boundaries))
+        for i in first:
+            boundary = boundaries[ekeys[i]]
+            if self.has_edge(l1[i], l2[i]):
+                self[l1[i]][l2[i]]['boundary'].update(boundary)
+            elif as_index_sets:
+                self.add_edge(l1[i], l2[i], boundary=boundary)
+            else:
+                self.add_edge(l1[i], l2[i], boundary=set(boundary))
+
+
+    def _parallel_boundary_pairs(self, inner_idxs, allow_shared_boundaries,
+                                 nozeros, n_jobs):
+        """Find boundary pairs for the whole volume in a process pool.
+
+        The raveled volume is split into slabs along the first axis.
+        Each process receives one slab, padded with enough voxels on
+        either side to look up the neighbors of all its voxels, so that
+        boundaries straddling slab faces are found exactly once.
+
+        Parameters
+        ----------
+        inner_idxs : array of int
+            The sorted linear indices of all voxels not in the boundary
+            body.
+        allow_shared_boundaries : bool
+            Passed on to ``_boundary_pairs``.
+        nozeros : bool
+            Passed on to ``_boundary_pairs``.
+        n_jobs : int
+            The number of processes to use.
+
+        Returns
+        -------
+        chunks : list of tuple of array
+            The ``(pos, k1, k2, l1, l2)`` arrays of each slab, where
+            `pos` is a position in `inner_idxs`.
+        """
+        ws = self.watershed_r
+        offsets = morpho.get_neighbor_idxs(self.watershed, 0,
+                                           self.connectivity)[0]
+        halo = int(np.abs(offsets).max())
+        plane = self.watershed.size // self.watershed.shape[0]
+        nplanes = max(1, -(-_GRAPH_BUILD_CHUNK_SIZE // plane))
+        bounds = list(range(0, ws.size, nplanes * plane)) + [ws.size]
+        tasks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            padded = np.zeros(hi - lo + 2 * halo, ws.dtype)
+            a, b = max(lo - halo, 0), min(hi + halo, ws.size)
+            padded[a - lo + halo:b - lo + halo] = ws[a:b]
+            tasks.append((padded, halo, offsets, self.boundary_body,
+                          allow_shared_boundaries, nozeros))
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.map(_slab_boundary_pairs, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        chunks = []
+        for lo, (idxs, k1, k2, l1, l2, ignored) in zip(bounds, results):
+            pos = np.searchsorted(inner_idxs, idxs + lo)
+            chunks.append((pos, k1, k2, l1, l2))
+            if len(ignored) > 0:
+                self.ignored_boundary.ravel()[ignored + lo] = True
+        return chunks
 
 
     def set_feature_manager(self, feature_manager):
         """Set the feature manager and ensure feature caches are computed.
 
+        With lazy feature caches, existing caches are discarded instead,
+        to be created by the new manager when first needed.
+
         Parameters
         ----------
         feature_manager : ``features.base.Null`` object
@@ -655,7 +1823,15 @@ class Rag(Graph):
         None
         """
         self.feature_manager = feature_manager
-        self.compute_feature_caches()
+        if not self.lazy_feature_caches:
+            self.compute_feature_caches()
+            return
+        for n in self.nodes():
+            self.node[n].pop('feature-cache', None)
+        for n1, n2 in self.edges():
+            self[n1][n2].pop('feature-cache', None)
+        if self.feature_vector_cache is not None:
+            self.feature_vector_cache.clear()
 
 
     def compute_feature_caches(self):
@@ -669,14 +1845,84 @@ class Rag(Graph):
         -------
         None
         """
-        for n in ip.with_progress(
-                    self.nodes(), title='Node caches ', pbar=self.pbar):
-            self.node[n]['feature-cache'] = \
-                            self.feature_manager.create_node_cache(self, n)
-        for n1, n2 in ip.with_progress(
-                    self.edges(), title='Edge caches ', pbar=self.pbar):
-            self[n1][n2]['feature-cache'] = \
-                            self.feature_manager.create_edge_cache(self, n1, n2)
+        nodes = self.nodes()
+        node_caches = self.feature_manager.create_node_caches(self, nodes)
+        for n, cache in ip.with_progress(zip(nodes, node_caches),
+                    len(nodes), title='Node caches ', pbar=self.pbar):
+            self.node[n]['feature-cache'] = cache
+        edges = self.edges()
+        edge_caches = self.feature_manager.create_edge_caches(self, edges)
+        for (n1, n2), cache in ip.with_progress(zip(edges, edge_caches),
+                    len(edges), title='Edge caches ', pbar=self.pbar):
+            self[n1][n2]['feature-cache'] = cache
+        if self.feature_vector_cache is not None:
+            self.feature_vector_cache.clear()
+
+
+    def materialize_feature_caches(self, edges):
+        """Create any missing feature caches of the given edges and nodes.
+
+        Missing caches are computed in bulk, which is faster than
+        letting the feature manager create them one at a time. This
+        does nothing unless the graph has lazy feature caches.
+
+        Parameters
+        ----------
+        edges : list of (int, int)
+            The edges whose caches, and whose nodes' caches, are needed.
+
+        Returns
+        -------
+        None
+        """
+        if not getattr(self, 'lazy_feature_caches', False):
+            return
+        nodes = list(set(n for e in edges for n in e
+                         if 'feature-cache' not in self.node[n]))
+        if len(nodes) > 0:
+            caches = self.feature_manager.create_node_caches(self, nodes)
+            for n, cache in zip(nodes, caches):
+                self.node[n]['feature-cache'] = cache
+        edges = [(n1, n2) for n1, n2 in edges
+                 if 'feature-cache' not in self[n1][n2]]
+        if len(edges) > 0:
+            caches = self.feature_manager.create_edge_caches(self, edges)
+            for (n1, n2), cache in zip(edges, caches):
+                self[n1][n2]['feature-cache'] = cache
+
+
+    def edge_features(self, feature_map, n1, n2):
+        """Compute the feature vector of an edge, using the cache if possible.
+
+        Vectors computed by feature managers whose ``cacheable``
+        attribute is ``True`` are stored in ``Rag.feature_vector_cache``
+        and reused until `n1` or `n2` is merged. Other feature maps are
+        called directly. The cache counts hits and misses; see
+        ``FeatureVectorCache.stats``.
+
+        Parameters
+        ----------
+        feature_map : function (Rag, node, node) -> array of float
+            The map from node pairs to a feature vector.
+        n1, n2 : int
+            The nodes defining the edge.
+
+        Returns
+        -------
+        features : 1D array of float
+            The feature vector of the edge.
+        """
+        cache = self.feature_vector_cache
+        if cache is None or not getattr(feature_map, 'cacheable', False):
+            return feature_map(self, n1, n2)
+        if cache.owner is not feature_map:
+            cache.clear()
+            cache.owner = feature_map
+        features = cache.get((n1, n2))
+        if features is None:
+            features = feature_map(self, n1, n2)
+            cache.set((n1, n2), features)
+        return features
 
 
     def get_neighbor_idxs_fast(self, idxs):
@@ -729,6 +1975,32 @@ class Rag(Graph):
         return morpho.get_neighbor_idxs(self.watershed, idxs, connectivity)
 
 
+    def get_neighbor_idxs_strides(self, idxs):
+        """Compute neighbor indices by adding offsets to input indices.
+
+        The offsets from a voxel to its neighbors in the padded, raveled
+        volume are the same for every voxel, so they are computed once
+        by ``self.set_watershed(..., lowmem='strides')`` and added to
+        whole batches of indices at a time.
+
+        Parameters
+        ----------
+        idxs : int or iterable of int
+            A linear index or set of indices into the padded array.
+
+        Returns
+        -------
+        neighbors : array of int, shape `(len(idxs), N_neighbors)`
+            An array of linear indices to the neighbors of each input
+            index.
+
+        See Also
+        --------
+        ``self.set_watershed``
+        """
+        return np.add.outer(idxs, self.neighbor_offsets)
+
+
     def set_probabilities(self, probs=array([]), normalize=False):
         """Set the `probabilities` attributes of the RAG.
 
@@ -798,6 +2070,11 @@ class Rag(Graph):
         padding = [0]+(self.pad_thickness-1)*[0]
         self.orientation_map = morpho.pad(orientation_map, padding).astype(int)
         self.orientation_map_r = self.orientation_map.ravel()
+        self._set_oriented_probabilities(channel_is_oriented)
+
+
+    def _set_oriented_probabilities(self, channel_is_oriented):
+        """Split the probabilities into oriented and non-oriented channels."""
         if channel_is_oriented is None:
             nchannels = 1 if self.probabilities.ndim==self.watershed.ndim \
                 else self.probabilities.shape[-1]
@@ -819,7 +2096,7 @@ class Rag(Graph):
                 self.probabilities_r[:, ~self.channel_is_oriented]
 
 
-    def set_watershed(self, ws=array([]), lowmem=False, connectivity=1):
+    def set_watershed(self, ws=array([]), lowmem=None, connectivity=1):
         """Set the initial segmentation volume (watershed).
 
         The initial segmentation is called `watershed` for historical
@@ -829,9 +2106,13 @@ class Rag(Graph):
         ----------
         ws : array of int
             The initial segmentation.
-        lowmem : bool, optional
+        lowmem : bool or 'strides', optional
             Whether to use a low memory/high time mode. This usually
             results in about 10% less memory usage and 10% more time.
+            If ``'strides'``, compute neighbors from the volume strides
+            instead, using no extra memory and little extra time. If
+            ``None`` (default), use ``'strides'`` for volumes larger
+            than 2**24 voxels, and the neighbors array otherwise.
         connectivity : int in {1, ..., `ws.ndim`}, optional
             The pixel neighborhood.
 
@@ -851,7 +2132,23 @@ class Rag(Graph):
             self.watershed = morpho.pad(ws, self.boundary_body)
         self.watershed_r = self.watershed.ravel()
         self.pad_thickness = 2 if (self.watershed == 0).any() else 1
-        if lowmem:
+        self._set_neighbor_idxs(lowmem, connectivity)
+
+
+    def _set_neighbor_idxs(self, lowmem=None, connectivity=1):
+        """Choose how ``self.neighbor_idxs`` finds neighbors of voxels.
+
+        See ``set_watershed`` for the meaning of `lowmem`.
+        """
+        if lowmem is None:
+            large = self.watershed.size > _NEIGHBOR_ARRAY_MAX_SIZE
+            lowmem = 'strides' if large else False
+        if lowmem == 'strides':
+            offsets = morpho.get_neighbor_idxs(self.watershed, 0, connectivity)
+            self.neighbor_offsets = \
+                    offsets[0].astype(index_dtype(self.watershed.size))
+            self.neighbor_idxs = self.get_neighbor_idxs_strides
+        elif lowmem:
             def neighbor_idxs(x):
                 return self.get_neighbor_idxs_lean(x, connectivity)
             self.neighbor_idxs = neighbor_idxs
@@ -882,17 +2179,19 @@ class Rag(Graph):
             seg_ignore = [0, self.boundary_body] if \
                         (self.watershed==0).any() else [self.boundary_body]
             self.gt = morpho.pad(gt, gt_ignore)
-            self.rig = contingency_table(self.watershed, self.gt,
-                                         ignore_seg=seg_ignore,
-                                         ignore_gt=gt_ignore)
+            self.rig = Rig(ev_contingency_table(self.watershed, self.gt,
+                                                ignore_seg=seg_ignore,
+                                                ignore_gt=gt_ignore))
+            self.rig_split_vi = self.rig.split_vi()
         else:
             self.gt = None
+            self.rig_split_vi = None
             # null pattern to transparently allow merging of nodes.
             # Bonus feature: counts how many sp's went into a single node.
             try:
-                self.rig = ones(2 * self.watershed.max() + 1)
+                self.rig = Rig(ones((self.watershed.max() + 1, 1)))
             except ValueError:
-                self.rig = ones(2 * self.number_of_nodes() + 1)
+                self.rig = Rig(ones((self.number_of_nodes() + 1, 1)))
 
 
     def set_exclusions(self, excl):
@@ -919,7 +2218,7 @@ class Rag(Graph):
             excl = morpho.pad(excl, [0]*self.pad_thickness)
         for n in self.nodes():
             if excl.size != 0:
-                eids = unique(excl.ravel()[list(self.extent(n))])
+                eids = unique(excl.ravel()[as_array(self.extent(n))])
                 eids = eids[flatnonzero(eids)]
                 self.node[n]['exclusions'] = set(list(eids))
             else:
@@ -952,13 +2251,53 @@ class Rag(Graph):
             in the queue with a new priority.
         """
         queue_items = []
-        for l1, l2 in self.real_edges_iter():
-            w = self.merge_priority_function(self,l1,l2)
+        edges = list(self.real_edges_iter())
+        if self.undo_log is not None:
+            self.undo_log.append(('queue', (self.merge_queue,
+                    [(l1, l2, self[l1][l2].get('weight'),
+                      self[l1][l2].get('qlink')) for l1, l2 in edges])))
+        for (l1, l2), w in zip(edges, self.merge_priorities(edges)):
             qitem = [w, True, l1, l2]
             queue_items.append(qitem)
             self[l1][l2]['qlink'] = qitem
             self[l1][l2]['weight'] = w
-        return MergeQueue(queue_items, with_progress=self.show_progress)
+        return self._new_merge_queue(queue_items,
+                                     with_progress=self.show_progress)
+
+
+    def _new_merge_queue(self, items=[], **kwargs):
+        """Return a merge queue of the type selected at construction."""
+        if getattr(self, 'merge_queue_type', 'lazy') == 'indexed':
+            return IndexedMergeQueue(items, **kwargs)
+        return MergeQueue(items, compact_ratio=getattr(self,
+                          'merge_queue_compact_ratio', None), **kwargs)
+
+
+    def merge_priorities(self, edges):
+        """Compute the merge priority of many edges at once.
+
+        If the merge priority function has a ``batch`` attribute, it is
+        called as ``batch(g, edges)`` and should return an array of
+        priorities, one per edge. (See ``batch_priority``.) This
+        allows, for example, ``classifier_probability`` to compute a
+        single feature matrix and call the classifier only once.
+        Otherwise, the merge priority function is called on each edge
+        in turn.
+
+        Parameters
+        ----------
+        edges : list of (int, int)
+            The edges to be scored.
+
+        Returns
+        -------
+        priorities : array-like, length ``len(edges)``
+            The merge priority of each edge.
+        """
+        batch = getattr(self.merge_priority_function, 'batch', None)
+        if batch is not None and len(edges) > 0:
+            return batch(self, edges)
+        return [self.merge_priority_function(self, u, v) for u, v in edges]
 
 
     def rebuild_merge_queue(self):
@@ -1016,6 +2355,49 @@ class Rag(Graph):
             return history, scores, evaluation
 
 
+    def agglomerate_sweep(self, thresholds):
+        """Agglomerate through several thresholds, yielding a map at each.
+
+        The agglomeration is run once, in order of increasing
+        threshold. Each time a threshold is reached, the map from
+        superpixels to segments is captured, rather than the full
+        segmentation volume. It can be written with
+        ``imio.write_mapped_segmentation``, or turned into a volume
+        with ``imio.apply_segmentation_map``.
+
+        Parameters
+        ----------
+        thresholds : iterable of float
+            The edge priorities at which to capture the segmentation.
+
+        Yields
+        ------
+        threshold : float
+            The threshold just reached.
+        sp_to_body : array of int64, shape (NUM_SPS, 2)
+            The superpixel to segment map at `threshold`. See
+            ``Rag.get_sp_to_body_map``.
+
+        Notes
+        -----
+        The graph is agglomerated to each threshold when the next map
+        is requested, so the graph can also be inspected or modified,
+        for example to remove inclusions, between thresholds.
+
+        Examples
+        --------
+        >>> ws = np.array([[1, 1, 2, 3]])
+        >>> g = Rag(ws, np.array([[0.0, 0.2, 0.4, 0.5]]))
+        >>> for t, sp_to_body in g.agglomerate_sweep([0.5, 0.35]):
+        ...     print('%.2f %i' % (t, len(np.unique(sp_to_body[1:, 1]))))
+        0.35 2
+        0.50 1
+        """
+        for threshold in sorted(thresholds):
+            self.agglomerate(threshold)
+            yield threshold, self.get_sp_to_body_map()
+
+
     def agglomerate_count(self, stepsize=100, save_history=False):
         """Agglomerate until 'stepsize' merges have been made.
 
@@ -1101,7 +2483,11 @@ class Rag(Graph):
         self.merge_queue.finish()
         self.rebuild_merge_queue()
         max_score = max([qitem[0] for qitem in self.merge_queue.q])
-        self.ucm -= max_score
+        if self.ucm is not None:
+            self.ucm = self._painted_ucm()
+            self.ucm_r = self.ucm.ravel()
+            self.ucm_log = []
+            self.ucm -= max_score
         for n in self.tree.nodes():
             self.tree.node[n]['w'] -= max_score
 
@@ -1229,10 +2615,13 @@ class Rag(Graph):
         label_type_keys = {'assignment':0, 'vi-sign':1, 'rand-sign':2}
         if type(gts) != list:
             gts = [gts] # allow using single ground truth as input
-        master_ctables = \
-                [contingency_table(self.get_segmentation(), gt) for gt in gts]
+        master_ctables = [Rig(ev_contingency_table(self.get_segmentation(),
+                                                   gt)) for gt in gts]
         alldata = []
         data = [[],[],[],[]]
+        # each epoch agglomerates self, and is then undone
+        merge_priority_function = self.merge_priority_function
+        show_progress = self.show_progress
         for num_epochs in range(max_num_epochs):
             ctables = deepcopy(master_ctables)
             if len(data[0]) > min_num_samples and num_epochs >= min_num_epochs:
@@ -1242,7 +2631,7 @@ class Rag(Graph):
                 data = unique_learning_data_elements(alldata) if memory \
                     else alldata[-1]
                 continue
-            g = self.copy()
+            g = self
             if priority_mode == 'mean':
                 g.merge_priority_function = boundary_mean
             elif num_epochs > 0 and priority_mode == 'active' or \
@@ -1263,9 +2652,20 @@ class Rag(Graph):
                 g.merge_priority_function = mpf
             g.show_progress = False # bug in MergeQueue usage causes
                                     # progressbar crash.
-            g.rebuild_merge_queue()
-            alldata.append(g._learn_agglomerate(ctables, feature_map,
+            snapshot = g.snapshot()
+            try:
+                g.rebuild_merge_queue()
+                alldata.append(g._learn_agglomerate(ctables, feature_map,
                                                 learning_mode, labeling_mode))
+            finally:
+                g.restore(snapshot)
+                g.merge_priority_function = merge_priority_function
+                g.show_progress = show_progress
+            if g.feature_vector_cache is not None:
+                cache = g.feature_vector_cache
+                logging.debug('feature vector cache at epoch %d: '
+                              '%d hits, %d misses' %
+                              (num_epochs, cache.hits, cache.misses))
             if memory:
                 if unique:
                     data = unique_learning_data_elements(alldata)
@@ -1308,8 +2708,10 @@ class Rag(Graph):
         """
         if type(gts) != list:
             gts = [gts] # allow using single ground truth as input
-        ctables = [contingency_table(self.get_segmentation(), gt) for gt in gts]
-        assignments = [(ct == ct.max(axis=1)[:,newaxis]) for ct in ctables]
+        ctables = [Rig(ev_contingency_table(self.get_segmentation(), gt))
+                   for gt in gts]
+        assignments = [dict((n, ct.best(n)) for n in self.nodes())
+                       for ct in ctables]
         return list(map(array, zip(*[
                 self.learn_edge(e, ctables, assignments, feature_map)
                 for e in self.real_edges()])))
@@ -1322,12 +2724,13 @@ class Rag(Graph):
         ----------
         edge : (int, int) tuple
             An edge in the graph.
-        ctables : list of array
+        ctables : list of Rig or array
             A list of contingency tables determining overlap between the
             current segmentation and the ground truth.
-        assignments : list of array
-            Similar to the contingency tables, but each row is thresholded
-            so each segment corresponds to exactly one ground truth segment.
+        assignments : list of dict or array
+            For each contingency table, the ground truth segments that
+            each segment overlaps most, as returned by ``Rig.best``, or
+            a boolean array with the maximum of each row set.
         feature_map : function (Rag, node, node) -> array of float
             The map from node pairs to a feature vector.
 
@@ -1347,7 +2750,7 @@ class Rag(Graph):
             The given edge.
         """
         n1, n2 = edge
-        features = feature_map(self, n1, n2).ravel()
+        features = self.edge_features(feature_map, n1, n2).ravel()
         # Calculate weights for weighting data points
         s1, s2 = [self.node[n]['size'] for n in [n1, n2]]
         weights = \
@@ -1356,7 +2759,7 @@ class Rag(Graph):
         # Get the fraction of times that n1 and n2 assigned to
         # same segment in the ground truths
         cont_labels = [
-            [(-1)**(a[n1,:]==a[n2,:]).all() for a in assignments],
+            [(-1)**np.array_equal(a[n1], a[n2]) for a in assignments],
             [compute_true_delta_vi(ctable, n1, n2) for ctable in ctables],
             [-compute_true_delta_rand(ctable, n1, n2, self.volume_size)
                                                     for ctable in ctables]
@@ -1377,9 +2780,9 @@ class Rag(Graph):
 
         Parameters
         ----------
-        ctables : array of float or list thereof
+        ctables : list of Rig
             One or more contingency tables between own segments and gold
-            standard segmentations
+            standard segmentations. They are updated with each merge.
         feature_map : function (Rag, node, node) -> array of float
             The map from node pairs to a feature vector. This must
             consist either of uncached features or of the cache used
@@ -1404,7 +2807,8 @@ class Rag(Graph):
                 - the list of merged edges ``(n_edges, 2)``.
         """
         label_type_keys = {'assignment':0, 'vi-sign':1, 'rand-sign':2}
-        assignments = [(ct == ct.max(axis=1)[:,newaxis]) for ct in ctables]
+        assignments = [dict((n, ct.best(n)) for n in self.nodes())
+                       for ct in ctables]
         g = self
         data = []
         while len(g.merge_queue) > 0:
@@ -1415,13 +2819,9 @@ class Rag(Graph):
             if learning_mode != 'strict' or label < 0:
                 node_id = g.merge_nodes(n1, n2, merge_priority)
                 for ctable, assignment in zip(ctables, assignments):
-                    ctable[node_id] = ctable[n1] + ctable[n2]
-                    ctable[n1] = 0
-                    ctable[n2] = 0
-                    assignment[node_id] = (ctable[node_id] ==
-                                           ctable[node_id].max())
-                    assignment[n1] = 0
-                    assignment[n2] = 0
+                    ctable.merge(n1, n2, node_id)
+                    assignment[node_id] = ctable.best(node_id)
+                    del assignment[n1], assignment[n2]
         return list(map(array, zip(*data)))
 
 
@@ -1497,8 +2897,11 @@ class Rag(Graph):
         w = edge['weight'] if 'weight' in edge else -inf
         if self.ucm is not None:
             self.max_merge_score = max(self.max_merge_score, w)
-            idxs = list(edge['boundary'])
-            self.ucm_r[idxs] = self.max_merge_score
+            if self.ucm_mode == 'deferred':
+                # the edge is removed by the merge, so its boundary is final
+                self.ucm_log.append((edge['boundary'], self.max_merge_score))
+            else:
+                self.ucm_r[as_array(edge['boundary'])] = self.max_merge_score
 
 
     def update_max_ucm(self, n1, n2):
@@ -1515,7 +2918,12 @@ class Rag(Graph):
         """
         edge = self[n1][n2]
         if self.ucm is not None:
-            self.ucm_r[list(edge['boundary'])] = inf
+            if self.ucm_mode == 'deferred':
+                # the edge remains in the graph, and its boundary can grow
+                self.ucm_log.append((np.copy(as_array(edge['boundary'])),
+                                     inf))
+            else:
+                self.ucm_r[as_array(edge['boundary'])] = inf
 
 
     def rename_node(self, old, new):
@@ -1564,40 +2972,163 @@ class Rag(Graph):
         Additionally, the RIG (region intersection graph), the
         contingency matrix to the ground truth (if provided) is
         updated.
+
+        If a snapshot is open, the changes are recorded so that they
+        can be undone. See ``Rag.snapshot``.
         """
+        record = None
+        if self.undo_log is not None:
+            record = self._record_merge(n1, n2)
+            self.undo_log.append(('merge', record))
         if len(self.node[n1]['exclusions'] & self.node[n2]['exclusions']) > 0:
             self.update_max_ucm(n1, n2)
             return
         else:
             self.node[n1]['exclusions'].update(self.node[n2]['exclusions'])
+        if self.feature_vector_cache is not None:
+            self.feature_vector_cache.invalidate_nodes([n1, n2])
         self.update_ucm(n1, n2)
         w = self[n1][n2].get('weight', merge_priority)
+        # nodes without feature caches are merged lazily, by their voxels
+        update_cache = ('feature-cache' in self.node[n1] or
+                        'feature-cache' in self.node[n2])
+        if update_cache:
+            c1, c2 = [self.feature_manager.node_cache(self, n)
+                      for n in [n1, n2]]
         self.node[n1]['size'] += self.node[n2]['size']
         self.node[n1]['watershed_ids'] += self.node[n2]['watershed_ids']
 
-        self.feature_manager.update_node_cache(self, n1, n2,
-                self.node[n1]['feature-cache'], self.node[n2]['feature-cache'])
+        if update_cache:
+            self.feature_manager.update_node_cache(self, n1, n2, c1, c2)
         new_neighbors = [n for n in self.neighbors(n2)
                          if n not in [n1, self.boundary_body]]
-        for n in new_neighbors:
-            self.merge_edge_properties((n2, n), (n1, n))
-        # this if statement enables merging of non-adjacent nodes
-        if self.has_edge(n1,n2) and self.has_zero_boundaries:
-            sp2segment = self.tree.get_map(w)
-            self.refine_post_merge_boundaries(n1, n2, sp2segment)
+        # defer re-scoring of the affected edges until all are updated
+        self.dirty_edges = {}
+        try:
+            for n in new_neighbors:
+                self.merge_edge_properties((n2, n), (n1, n))
+            # this if statement enables merging of non-adjacent nodes
+            if self.has_edge(n1,n2) and self.has_zero_boundaries:
+                self.refine_post_merge_boundaries(n1, n2, self.segment_map)
+            self.flush_dirty_edges(exclude=[(n1, n2)])
+        finally:
+            # never leave later queue updates deferred after an error
+            self.dirty_edges = None
         try:
             self.merge_queue.invalidate(self[n1][n2]['qlink'])
         except KeyError:
             pass
         node_id = self.tree.merge(n1, n2, w)
+        self.segment_map.union(n1, n2, node_id)
         self.remove_node(n2)
         self.rename_node(n1, node_id)
-        self.rig[node_id] = self.rig[n1] + self.rig[n2]
-        self.rig[n1] = 0
-        self.rig[n2] = 0
+        row1, row2 = self.rig.merge(n1, n2, node_id)
+        if record is not None:
+            record['node_id'] = node_id
+            record['rig'] = (n1, n2, row1, row2)
+            record['rig_split_vi'] = self.rig_split_vi
+        if self.rig_split_vi is not None:
+            self.rig_split_vi = self.rig_split_vi + split_vi_delta(
+                        row1[1], row2[1], self.rig.values(node_id))
         return node_id
 
 
+    def _record_merge(self, n1, n2):
+        """Record the state that merging `n1` and `n2` will change.
+
+        Parameters
+        ----------
+        n1, n2 : int
+            The nodes about to be merged by ``merge_nodes``.
+
+        Returns
+        -------
+        record : dict
+            The attributes of the nodes and of their edges, whether
+            and with what priority each edge was queued, the UCM values
+            on the boundary between the nodes, and the maximum merge
+            scores. ``merge_nodes`` adds the id of the new node and the
+            rows of the RIG it changes.
+        """
+        record = {'nodes': {}, 'edges': [], 'node_id': None,
+                  'max_merge_score': self.max_merge_score,
+                  'tree_maxw': self.tree.maxw, 'ucm': None}
+        if self.ucm is not None and self.ucm_mode == 'deferred':
+            record['ucm'] = len(self.ucm_log)
+        elif self.ucm is not None and self.has_edge(n1, n2):
+            idxs = as_array(self[n1][n2]['boundary'])
+            record['ucm'] = (idxs, self.ucm_r[idxs])
+        if len(self.node[n1]['exclusions'] & self.node[n2]['exclusions']) > 0:
+            return record # the merge only changes the UCM
+        for n in [n1, n2]:
+            record['nodes'][n] = _copy_attributes(self.node[n])
+        for u, v in self.edges_iter([n1, n2]):
+            qitem = self[u][v].get('qlink')
+            # the item of the merged edge has usually just been popped
+            queued = qitem is not None and (qitem[1] or {u, v} == {n1, n2})
+            priority = qitem[0] if queued else None
+            record['edges'].append(
+                            (u, v, _copy_attributes(self[u][v]), priority))
+        return record
+
+
+    def _undo_merge(self, record):
+        """Undo a merge recorded by ``_record_merge``."""
+        node_id = record['node_id']
+        if node_id is not None:
+            for v in self.neighbors(node_id):
+                qitem = self[node_id][v].get('qlink')
+                if qitem is not None:
+                    self.merge_queue.invalidate(qitem)
+            self.remove_node(node_id)
+            self.tree.remove_node(node_id)
+            self.tree.id_counter = it.count(node_id)
+            self.segment_map.assign(
+                (n, attrs.get('watershed_ids', [n]))
+                for n, attrs in record['nodes'].items())
+            self.rig.unmerge(node_id, *record['rig'])
+            self.rig_split_vi = record['rig_split_vi']
+            if self.feature_vector_cache is not None:
+                # edges re-scored during the merge were cached under the
+                # original node ids, before `n1` was renamed
+                self.feature_vector_cache.invalidate_nodes(
+                                        [node_id] + list(record['nodes']))
+        for n, attrs in record['nodes'].items():
+            if n not in self:
+                self.add_node(n)
+            self.node[n] = attrs
+        for u, v, attrs, priority in record['edges']:
+            self.add_edge(u, v)
+            self.adj[u][v] = self.adj[v][u] = attrs
+            if priority is not None:
+                # the original queue item was invalidated by the merge
+                attrs['qlink'] = [priority, True, u, v]
+                self.merge_queue.push(attrs['qlink'])
+        if isinstance(record['ucm'], int):
+            del self.ucm_log[record['ucm']:]
+        elif record['ucm'] is not None:
+            idxs, values = record['ucm']
+            self.ucm_r[idxs] = values
+        self.max_merge_score = record['max_merge_score']
+        self.tree.maxw = record['tree_maxw']
+
+
+    def _undo_queue(self, record):
+        """Restore the merge queue replaced by ``build_merge_queue``."""
+        self.merge_queue, edges = record
+        for u, v, weight, qlink in edges:
+            for key, value in [('weight', weight), ('qlink', qlink)]:
+                if value is None:
+                    self[u][v].pop(key, None)
+                else:
+                    self[u][v][key] = value
+
+
+    def _undo_frozen(self, record):
+        """Restore the frozen node and edge sets."""
+        self.frozen_nodes, self.frozen_edges = record
+
+
     def refine_post_merge_boundaries(self, n1, n2, sp2segment):
         """Ensure boundary pixels are only counted once after a merge.
 
@@ -1605,18 +3136,20 @@ class Rag(Graph):
         ----------
         n1, n2 : int
             Nodes determining the edge for which to update the UCM.
-        sp2segment : array of int
-            The most recent map from superpixels to segments.
+        sp2segment : array of int or ``UnionFind``
+            The current map from superpixels to segments.
         """
-        boundary = array(list(self[n1][n2]['boundary']))
+        boundary = as_array(self[n1][n2]['boundary'])
         boundary_neighbor_pixels = sp2segment[self.watershed_r[
                                               self.neighbor_idxs(boundary)]]
         add = ((boundary_neighbor_pixels == 0) +
                (boundary_neighbor_pixels == n1) +
                (boundary_neighbor_pixels == n2)).all(axis=1)
         check = True - add
+        # the absorbed boundary is not part of the extent, so n1 needs
+        # a feature cache to keep track of it
         self.feature_manager.pixelwise_update_node_cache(self, n1,
-                        self.node[n1]['feature-cache'], boundary[add])
+                self.feature_manager.node_cache(self, n1), boundary[add])
         boundaries_to_edit = {}
         for px in boundary[check]:
             px_neighbors = self.neighbor_idxs(px)
@@ -1632,12 +3165,14 @@ class Rag(Graph):
             if self.has_edge(u, v):
                 idxs = idxs - self[u][v]['boundary']
                 self[u][v]['boundary'].update(idxs)
-                self.feature_manager.pixelwise_update_edge_cache(self, u, v,
-                                    self[u][v]['feature-cache'], list(idxs))
+                if 'feature-cache' in self[u][v]:
+                    self.feature_manager.pixelwise_update_edge_cache(self,
+                                u, v, self[u][v]['feature-cache'], list(idxs))
             else:
-                self.add_edge(u, v, boundary=set(idxs))
-                self[u][v]['feature-cache'] = \
-                    self.feature_manager.create_edge_cache(self, u, v)
+                self.add_edge(u, v, boundary=self._new_index_set(idxs))
+                if not getattr(self, 'lazy_feature_caches', False):
+                    self[u][v]['feature-cache'] = \
+                        self.feature_manager.create_edge_cache(self, u, v)
             self.update_merge_queue(u, v)
         for n in self.neighbors(n2):
             if (n1,n) not in boundaries_to_edit and n != n1:
@@ -1717,9 +3252,16 @@ class Rag(Graph):
         if not self.has_edge(u,v):
             self.add_edge(u, v, attr_dict=self[w][x])
         else:
+            # edges without feature caches are merged lazily, by boundary
+            update_cache = ('feature-cache' in self[u][v] or
+                            'feature-cache' in self[w][x])
+            if update_cache:
+                dst, src = [self.feature_manager.edge_cache(self, *e)
+                            for e in [(u, v), (w, x)]]
             self[u][v]['boundary'].update(self[w][x]['boundary'])
-            self.feature_manager.update_edge_cache(self, (u, v), (w, x),
-                    self[u][v]['feature-cache'], self[w][x]['feature-cache'])
+            if update_cache:
+                self.feature_manager.update_edge_cache(self, (u, v), (w, x),
+                                                       dst, src)
         try:
             self.merge_queue.invalidate(self[w][x]['qlink'])
         except KeyError:
@@ -1741,14 +3283,81 @@ class Rag(Graph):
         """
         if self.boundary_body in [u, v]:
             return
-        if 'qlink' in self[u][v]:
-            self.merge_queue.invalidate(self[u][v]['qlink'])
-        if not self.merge_queue.is_null_queue:
-            w = self.merge_priority_function(self,u,v)
+        if self.dirty_edges is not None:
+            self.dirty_edges[tuple(sorted((u, v)))] = (u, v)
+            return
+        qitem = self[u][v].get('qlink', None)
+        if self.merge_queue.is_null_queue:
+            if qitem is not None:
+                self.merge_queue.invalidate(qitem)
+            return
+        w = self.merge_priority_function(self,u,v)
+        new_qitem = [w, True, u, v]
+        if qitem is None:
+            self.merge_queue.push(new_qitem)
+        else:
+            new_qitem = self.merge_queue.update(qitem, new_qitem)
+        self[u][v]['qlink'] = new_qitem
+        self[u][v]['weight'] = w
+
+
+    def update_merge_queue_batch(self, edges):
+        """Update the merge queue items for many edges at once.
+
+        This is equivalent to calling ``Rag.update_merge_queue`` on each
+        edge, but the new priorities are computed with a single call to
+        ``Rag.merge_priorities``.
+
+        Parameters
+        ----------
+        edges : list of (int, int)
+            Edges being updated.
+
+        Returns
+        -------
+        None
+        """
+        edges = [(u, v) for u, v in edges if self.boundary_body not in (u, v)]
+        if self.merge_queue.is_null_queue:
+            for u, v in edges:
+                self.update_merge_queue(u, v)
+            return
+        for (u, v), w in zip(edges, self.merge_priorities(edges)):
+            qitem = self[u][v].get('qlink', None)
             new_qitem = [w, True, u, v]
+            if qitem is None:
+                self.merge_queue.push(new_qitem)
+            else:
+                new_qitem = self.merge_queue.update(qitem, new_qitem)
             self[u][v]['qlink'] = new_qitem
             self[u][v]['weight'] = w
-            self.merge_queue.push(new_qitem)
+
+
+    def flush_dirty_edges(self, exclude=()):
+        """Re-score all edges marked as dirty, and stop deferring updates.
+
+        While ``Rag.dirty_edges`` is a dictionary, ``update_merge_queue``
+        records edges in it instead of re-scoring them immediately.
+        ``merge_nodes`` uses this to re-score each edge affected by a
+        merge only once, in a single call to ``Rag.merge_priorities``.
+
+        Parameters
+        ----------
+        exclude : list of (int, int), optional
+            Dirty edges that should not be re-scored, for example
+            because they are about to be removed.
+
+        Returns
+        -------
+        None
+        """
+        dirty_edges = self.dirty_edges
+        self.dirty_edges = None
+        if dirty_edges is None:
+            return
+        for u, v in exclude:
+            dirty_edges.pop(tuple(sorted((u, v))), None)
+        self.update_merge_queue_batch(list(dirty_edges.values()))
 
 
     def get_segmentation(self):
@@ -1772,13 +3381,42 @@ class Rag(Graph):
         --------
         ``agglo.Rag.get_ucm``
         """
-        m = self.tree.get_map()
+        m = self.segment_map.get_map()
         seg = m[self.watershed]
         if self.pad_thickness > 1: # volume has zero-boundaries
             seg = morpho.remove_merged_boundaries(seg, self.connectivity)
         return morpho.juicy_center(seg, self.pad_thickness)
 
 
+    def get_sp_to_body_map(self):
+        """Return the current map from superpixels to segments.
+
+        This is computed from the merges made so far, in time
+        proportional to the number of superpixels, without building
+        the segmentation volume.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        sp_to_body : array of int64, shape (NUM_SPS, 2)
+            Rows of (superpixel, segment) pairs, including (0, 0), in
+            the format used by ``imio.write_mapped_segmentation``.
+
+        Notes
+        -----
+        Unlike ``get_segmentation``, this does not remove the 0-labeled
+        boundaries between merged superpixels.
+        """
+        forward_map = self.segment_map.get_map()
+        sps = np.flatnonzero(forward_map)
+        sps = sps[sps != self.boundary_body]
+        return np.column_stack((np.r_[0, sps], np.r_[0, forward_map[sps]])
+                               ).astype(np.int64)
+
+
     def get_ucm(self):
         """Return the current, unpadded ultrametric contour map.
 
@@ -1800,16 +3438,48 @@ class Rag(Graph):
         ucm : array of float
             The map of boundary values between segments implied by the
             hierarchical agglomeration process.
+
+        Raises
+        ------
+        ValueError
+            If the graph was created with ``ucm_mode='off'``.
         """
+        if self.ucm is None:
+            raise ValueError('The UCM is not tracked by this graph')
+        ucm = self._painted_ucm()
+        if len(self.ucm_log) > 0 and self.undo_log is None:
+            # keep the painted map; while a snapshot is open, the log
+            # must stay intact so that merges can be undone
+            self.ucm, self.ucm_r, self.ucm_log = ucm, ucm.ravel(), []
         if hasattr(self, 'ignored_boundary'):
-            self.ucm[self.ignored_boundary] = self.max_merge_score
-        ucm = morpho.juicy_center(self.ucm, self.pad_thickness)
-        umin, umax = unique(ucm)[([1, -2],)]
+            ucm[self.ignored_boundary] = self.max_merge_score
+        ucm = morpho.juicy_center(ucm, self.pad_thickness)
+        finite = ucm[np.isfinite(ucm)]
+        umin, umax = ((finite.min(), finite.max()) if finite.size > 0
+                      else (0.0, 0.0))
         ucm[ucm==-inf] = umin-1
         ucm[ucm==inf] = umax+1
         return ucm
 
 
+    def _painted_ucm(self):
+        """Return the padded UCM with the deferred merge scores painted in.
+
+        Later entries of the log overwrite earlier ones, as they would
+        have if the UCM had been updated at each merge.
+        """
+        if self.ucm is None or len(self.ucm_log) == 0:
+            return self.ucm
+        idxs = [as_array(boundary) for boundary, _ in self.ucm_log]
+        scores = np.repeat([score for _, score in self.ucm_log],
+                           [len(i) for i in idxs])
+        idxs = np.concatenate(idxs)[::-1]
+        idxs, last = np.unique(idxs, return_index=True)
+        ucm = self.ucm.copy()
+        ucm.ravel()[idxs] = scores[::-1][last]
+        return ucm
+
+
     def build_volume(self, nbunch=None):
         """Return the segmentation induced by the graph.
 
@@ -1835,7 +3505,7 @@ class Rag(Graph):
         if nbunch is None:
             nbunch = self.nodes()
         for n in nbunch:
-            vr[list(self.extent(n))] = n
+            vr[as_array(self.extent(n))] = n
         return morpho.juicy_center(v,self.pad_thickness)
 
 
@@ -1861,7 +3531,7 @@ class Rag(Graph):
             ebunch = self.real_edges_iter()
         ebunch = sorted([(self[u][v]['weight'], u, v) for u, v in ebunch])
         for w, u, v in ebunch:
-            b = list(self[u][v]['boundary'])
+            b = as_array(self[u][v]['boundary'])
             mr[b] = w
         if hasattr(self, 'ignored_boundary'):
             m[self.ignored_boundary] = inf
@@ -1962,7 +3632,7 @@ class Rag(Graph):
         if not self.at_volume_boundary(n) or n == self.boundary_body:
             return False
         v = zeros(self.watershed.shape, uint8)
-        v.ravel()[list(self[n][self.boundary_body]['boundary'])] = 1
+        v.ravel()[as_array(self[n][self.boundary_body]['boundary'])] = 1
         _, n = label(v, ones([3]*v.ndim))
         return n > 1
 
@@ -2003,11 +3673,11 @@ class Rag(Graph):
 
 
     def should_merge(self, n1, n2):
-        return self.rig[n1].argmax() == self.rig[n2].argmax()
+        return self.rig.argmax(n1) == self.rig.argmax(n2)
 
 
     def get_pixel_label(self, n1, n2):
-        boundary = array(list(self[n1][n2]['boundary']))
+        boundary = as_array(self[n1][n2]['boundary'])
         min_idx = boundary[self.probabilities_r[boundary,0].argmin()]
         if self.should_merge(n1, n2):
             return min_idx, 2
@@ -2026,18 +3696,59 @@ class Rag(Graph):
 
 
     def split_vi(self, gt=None):
+        """Return the split VI of the current segmentation.
+
+        With the ground truth given to ``set_ground_truth``, the
+        conditional entropies are updated by ``merge_nodes``, so this
+        takes constant time.
+
+        Parameters
+        ----------
+        gt : array of int, optional
+            A ground truth volume to compare to, when none was set.
+
+        Returns
+        -------
+        sv : array of float, shape (2,)
+            The false merge and false split terms, H(Y|X) and H(X|Y).
+        """
         if self.gt is None and gt is None:
             return array([0,0])
         elif self.gt is not None:
-            return split_vi(None, None, self.rig)
+            return self.rig_split_vi.copy()
         else:
-            return split_vi(self.get_segmentation(), gt, None, [0], [0])
+            return split_vi(self.get_segmentation(), gt, [0], [0])
 
 
     def boundary_indices(self, n1, n2):
         return list(self[n1][n2]['boundary'])
 
 
+    def boundary_nbytes(self, edges=None):
+        """Report the memory used to store the boundary of each edge.
+
+        Parameters
+        ----------
+        edges : iterable of (int, int), optional
+            The edges to report. All edges are reported by default.
+
+        Returns
+        -------
+        nbytes : dict of {(int, int): int}
+            The number of bytes used by each edge's boundary. For the
+            ``'set'`` backend, this is an estimate including the
+            Python integer objects.
+
+        See Also
+        --------
+        ``indexset.nbytes``
+        """
+        if edges is None:
+            edges = self.edges_iter()
+        return dict(((u, v), indexset.nbytes(self[u][v]['boundary']))
+                    for u, v in edges)
+
+
     def get_edge_coordinates(self, n1, n2, arbitrary=False):
         """Find where in the segmentation the edge (n1, n2) is most visible."""
         return get_edge_coordinates(self, n1, n2, arbitrary)
@@ -2144,6 +3855,10 @@ class Rag(Graph):
 
 
     def update_frozen_sets(self, n1, n2):
+        if self.undo_log is not None and (self.frozen_nodes or
+                                          self.frozen_edges):
+            self.undo_log.append(('frozen', (self.frozen_nodes.copy(),
+                                             self.frozen_edges.copy())))
         self.frozen_nodes.discard(n1)
         self.frozen_nodes.discard(n2)
         for x, y in self.frozen_edges.copy():
@@ -2163,30 +3878,67 @@ def get_edge_coordinates(g, n1, n2, arbitrary=False):
         idx = boundary.pop(); boundary.add(idx)
         coords = unravel_index(idx, g.watershed.shape)
     else:
-        boundary_idxs = unravel_index(list(boundary), g.watershed.shape)
+        boundary_idxs = unravel_index(as_array(boundary), g.watershed.shape)
         coords = [bincount(dimcoords).argmax() for dimcoords in boundary_idxs]
     return array(coords) - g.pad_thickness
 
 
 def is_mito_boundary(g, n1, n2, channel=2, threshold=0.5):
-        return max(np.mean(g.probabilities_r[list(g[n1][n2]["boundary"]), c]) \
+        return max(np.mean(g.probabilities_r[as_array(g[n1][n2]["boundary"]), c]) \
         for c in channel) > threshold
 
 
 def is_mito(g, n, channel=2, threshold=0.5):
-        return max(np.mean(g.probabilities_r[list(g.extent(n)), c]) \
+        return max(np.mean(g.probabilities_r[as_array(g.extent(n)), c]) \
         for c in channel) > threshold
 
 
 def best_possible_segmentation(ws, gt):
-    """Build the best possible segmentation given a superpixel map."""
-    cnt = contingency_table(ws, gt)
-    assignment = cnt == cnt.max(axis=1)[:,newaxis]
-    hard_assignment = where(assignment.sum(axis=1) > 1)[0]
-    # currently ignoring hard assignment nodes
-    assignment[hard_assignment,:] = 0
-    ws = Rag(ws)
-    for gt_node in range(1,cnt.shape[1]):
-        ws.merge_subgraph(where(assignment[:,gt_node])[0])
-    return ws.get_segmentation()
+    """Build the best possible segmentation given a superpixel map.
+
+    Each superpixel is assigned to the ground truth body it overlaps
+    most, and the superpixels assigned to the same body are merged.
+    Superpixels with a tie for the largest overlap, or no overlap, are
+    left unmerged.
 
+    Parameters
+    ----------
+    ws : array of int
+        The superpixel map, with 0-labeled boundaries or without.
+    gt : array of int, same shape as `ws`
+        The ground truth segmentation.
+
+    Returns
+    -------
+    seg : array of int, same shape as `ws`
+        The segmentation. Merged segments are numbered as they would
+        be by merging the superpixels in a ``Rag``.
+
+    Examples
+    --------
+    >>> ws = np.array([[1, 1, 2, 3, 3, 4]])
+    >>> gt = np.array([[1, 1, 1, 2, 2, 2]])
+    >>> best_possible_segmentation(ws, gt)
+    array([[6, 6, 6, 7, 7, 7]])
+    """
+    cont = ev_contingency_table(ws, gt, norm=False).tocoo()
+    max_overlap = np.zeros(cont.shape[0])
+    np.maximum.at(max_overlap, cont.row, cont.data)
+    is_max = cont.data == max_overlap[cont.row]
+    num_max = np.bincount(cont.row[is_max], minlength=cont.shape[0])
+    # superpixels with more than one best body are left unassigned
+    is_assigned = is_max & (num_max[cont.row] == 1)
+    sps, bodies = cont.row[is_assigned], cont.col[is_assigned]
+    order = np.argsort(bodies, kind='mergesort')
+    sps, bodies = sps[order], bodies[order]
+    # a Rag numbers new nodes from one past its boundary body, using one
+    # id per merge; the last id used for a body is the body's label
+    sizes = np.bincount(bodies)
+    last_ids = int(ws.max()) + 1 + np.cumsum(np.maximum(sizes - 1, 0))
+    labels = np.where(sizes[bodies] > 1, last_ids[bodies], sps)
+    forward_map = np.arange(int(ws.max()) + 1)
+    forward_map[sps] = labels
+    seg = forward_map[ws]
+    if (ws == 0).any():
+        seg = morpho.remove_merged_boundaries(seg)
+    return seg
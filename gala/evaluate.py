@@ -2,8 +2,9 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import math
+import warnings
 import numpy as np
-import multiprocessing
 import itertools as it
 import collections as coll
 from functools import partial
@@ -340,7 +341,8 @@ def relabel_from_one(label_field):
     return forward_map[label_field], forward_map, inverse_map
 
 
-def contingency_table(seg, gt, ignore_seg=[0], ignore_gt=[0], norm=True):
+def contingency_table(seg, gt, ignore_seg=[0], ignore_gt=[0], norm=True,
+                      chunk_size=2**24):
     """Return the contingency table for all regions in matched segmentations.
 
     Parameters
@@ -357,6 +359,12 @@ def contingency_table(seg, gt, ignore_seg=[0], ignore_gt=[0], norm=True):
         will not contribute to the contingency table. (default: [0])
     norm : bool, optional
         Whether to normalize the table so that it sums to 1.
+    chunk_size : int, optional
+        The number of voxels counted at a time. Each (seg, gt) label pair
+        is encoded as a single int64 key, and the keys of each chunk are
+        counted and merged into the running counts, so the memory used
+        depends on the chunk size and the number of distinct pairs,
+        rather than on the number of voxels.
 
     Returns
     -------
@@ -364,19 +372,39 @@ def contingency_table(seg, gt, ignore_seg=[0], ignore_gt=[0], norm=True):
         A contingency table. `cont[i, j]` will equal the number of voxels
         labeled `i` in `seg` and `j` in `gt`. (Or the proportion of such voxels
         if `norm=True`.)
+
+    Examples
+    --------
+    >>> seg = np.array([[1, 1, 2], [0, 2, 2]])
+    >>> gt = np.array([[1, 1, 1], [2, 2, 0]])
+    >>> contingency_table(seg, gt, norm=False).toarray()
+    array([[ 0.,  0.,  0.],
+           [ 0.,  2.,  0.],
+           [ 0.,  1.,  1.]])
     """
-    segr = seg.ravel() 
+    segr = seg.ravel()
     gtr = gt.ravel()
-    ij = np.vstack((segr, gtr))
-    selector = np.ones(segr.shape, np.bool)
-    data = np.ones(len(gtr))
-    for i in ignore_seg:
-        selector[segr == i] = 0
-    for j in ignore_gt:
-        selector[gtr == j] = 0
-    ij = ij[:, selector]
-    data = data[selector]
-    cont = sparse.coo_matrix((data, ij)).tocsc()
+    ny = int(gtr.max()) + 1 if gtr.size > 0 else 1
+    keys = np.zeros(0, np.int64)
+    counts = np.zeros(0, np.int64)
+    for start in range(0, segr.size, chunk_size):
+        segc = segr[start:start + chunk_size].astype(np.int64)
+        gtc = gtr[start:start + chunk_size].astype(np.int64)
+        selector = ~(np.in1d(segc, ignore_seg) | np.in1d(gtc, ignore_gt))
+        chunk_keys, idxs = np.unique(segc[selector] * ny + gtc[selector],
+                                     return_inverse=True)
+        chunk_counts = np.bincount(idxs)
+        if len(keys) == 0:
+            keys, counts = chunk_keys, chunk_counts
+        else:
+            keys, idxs = np.unique(np.concatenate((keys, chunk_keys)),
+                                   return_inverse=True)
+            counts = np.bincount(idxs, np.concatenate((counts, chunk_counts)),
+                                 minlength=len(keys)).astype(np.int64)
+    rows, cols = keys // ny, keys % ny
+    shape = ((rows.max() + 1, cols.max() + 1) if len(keys) > 0 else (0, 0))
+    cont = sparse.csc_matrix((counts.astype(float), (rows, cols)),
+                             shape=shape)
     if norm:
         cont /= float(cont.sum())
     return cont
@@ -633,6 +661,169 @@ def split_vi_threshold(tup):
     return split_vi(label(ucm<t)[0], gt, ignore_seg, ignore_gt)
 
 
+def _xlog2x(x):
+    """Compute x * log_2(x) for a non-negative scalar, with 0 log 0 = 0."""
+    return x * math.log(x, 2) if x > 0 else 0.0
+
+
+def _ucm_table_sums(ucm, gt, ts, ignore_seg=[], ignore_gt=[]):
+    """Yield contingency table sums of a UCM's segmentations at thresholds.
+
+    The segmentation at threshold `t` is ``label(ucm < t)[0]``. Rather
+    than labeling each one, the regions of the lowest UCM value are
+    labeled once, and the remaining voxels are added in order of UCM
+    value and joined to their neighbors with a union-find structure.
+    Each segment keeps its row of the contingency table with the ground
+    truth, and merging two segments updates the sums below in time
+    proportional to the smaller row.
+
+    Parameters
+    ----------
+    ucm : np.ndarray of float, arbitrary shape
+        The ultrametric contour map.
+    gt : np.ndarray of int, same shape as `ucm`
+        The ground truth segmentation.
+    ts : array of float
+        The thresholds, in increasing order.
+    ignore_seg : list of int, optional
+        If it contains 0, voxels above the threshold are not counted.
+        Other segment labels are arbitrary and are not ignored.
+    ignore_gt : list of int, optional
+        The labels to ignore in the ground truth.
+
+    Yields
+    ------
+    sums : tuple of float
+        For the table `n` with row sums `a` and column sums `b`: the
+        total, the sums of x log_2 x over `n`, `a` and `b`, and the sums
+        of squares of `n`, `a` and `b`.
+    """
+    ucm_r = ucm.ravel()
+    gt_r = gt.ravel().astype(np.int64)
+    valid = ~np.in1d(gt_r, ignore_gt)
+    count_zero = 0 not in ignore_seg
+    if len(ts) > 0:
+        regions = label(ucm < ts[0])[0].ravel().astype(np.int64)
+    else:
+        regions = np.zeros(ucm_r.shape, np.int64)
+    num_regions = int(regions.max()) if regions.size > 0 else 0
+    # elements of the union-find: the finest regions, then other voxels
+    others = np.flatnonzero(regions == 0)
+    elements = regions.copy()
+    elements[others] = num_regions + 1 + np.arange(len(others))
+    elements = elements.reshape(ucm.shape)
+    num_gt = int(gt_r.max()) + 1 if gt_r.size > 0 else 1
+    # neighbor pairs of elements, which join when both are below threshold
+    pairs, levels = [], []
+    for axis in range(ucm.ndim):
+        lo = [slice(None)] * ucm.ndim
+        hi = [slice(None)] * ucm.ndim
+        lo[axis], hi[axis] = slice(None, -1), slice(1, None)
+        lo, hi = tuple(lo), tuple(hi)
+        different = elements[lo] != elements[hi]
+        pairs.append(np.column_stack((elements[lo][different],
+                                      elements[hi][different])))
+        levels.append(np.maximum(ucm[lo], ucm[hi])[different])
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), int)
+    levels = np.concatenate(levels) if levels else np.zeros(0)
+    order = np.argsort(levels, kind='mergesort')
+    pairs, levels = pairs[order].tolist(), levels[order]
+    order = np.argsort(ucm_r[others], kind='mergesort')
+    others, other_levels = others[order], ucm_r[others][order]
+    other_elements = elements.ravel()[others].tolist()
+    # rows of the contingency table, by union-find root
+    parent = list(range(num_regions + len(others) + 1))
+    rows = [None] * len(parent)
+    sizes = [0] * len(parent)
+    in_regions = (regions > 0) & valid
+    keys, idxs = np.unique(regions[in_regions] * num_gt + gt_r[in_regions],
+                           return_inverse=True)
+    counts = np.bincount(idxs)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        r, g = divmod(key, num_gt)
+        if rows[r] is None:
+            rows[r] = {}
+        rows[r][g] = count
+        sizes[r] += count
+    for r in range(1, num_regions + 1):
+        if rows[r] is None:
+            rows[r] = {}
+    # the row of segment 0, the voxels at or above the threshold
+    row0 = np.bincount(gt_r[(regions == 0) & valid],
+                       minlength=num_gt).tolist()
+    size0 = sum(row0)
+    col = np.bincount(gt_r[in_regions], minlength=num_gt)
+    if count_zero:
+        col += np.array(row0, dtype=col.dtype)
+    col = col.tolist()
+    n = float(sum(col))
+    snn = float(sum(_xlog2x(c) for c in counts.tolist()))
+    q1 = float((counts.astype(float) ** 2).sum())
+    sa = float(sum(_xlog2x(a) for a in sizes))
+    q2 = float(sum(float(a) ** 2 for a in sizes))
+    if count_zero:
+        snn += sum(_xlog2x(c) for c in row0)
+        q1 += sum(float(c) ** 2 for c in row0)
+        sa += _xlog2x(size0)
+        q2 += float(size0) ** 2
+    sb = float(sum(_xlog2x(b) for b in col))
+    q3 = float(sum(float(b) ** 2 for b in col))
+
+    def find(e):
+        while parent[e] != e:
+            parent[e] = parent[parent[e]]
+            e = parent[e]
+        return e
+
+    i = j = 0
+    gt_others = gt_r[others].tolist()
+    valid_others = valid[others].tolist()
+    for t in ts:
+        while i < len(others) and other_levels[i] < t:
+            e, g = other_elements[i], gt_others[i]
+            if not valid_others[i]:
+                rows[e] = {}
+            else:
+                rows[e], sizes[e] = {g: 1}, 1
+                q1 += 1
+                q2 += 1
+                if count_zero:
+                    c = row0[g]
+                    snn += _xlog2x(c - 1) - _xlog2x(c)
+                    q1 += (c - 1) ** 2 - c ** 2
+                    sa += _xlog2x(size0 - 1) - _xlog2x(size0)
+                    q2 += (size0 - 1) ** 2 - size0 ** 2
+                    row0[g] -= 1
+                    size0 -= 1
+                else:
+                    b = col[g]
+                    n += 1
+                    sb += _xlog2x(b + 1) - _xlog2x(b)
+                    q3 += (b + 1) ** 2 - b ** 2
+                    col[g] += 1
+            i += 1
+        while j < len(pairs) and levels[j] < t:
+            u, v = find(pairs[j][0]), find(pairs[j][1])
+            j += 1
+            if u == v:
+                continue
+            if len(rows[u]) < len(rows[v]):
+                u, v = v, u
+            big, small = rows[u], rows[v]
+            for g, c in small.items():
+                old = big.get(g, 0)
+                snn += _xlog2x(old + c) - _xlog2x(old) - _xlog2x(c)
+                q1 += 2 * old * c
+                big[g] = old + c
+            a, b = sizes[u], sizes[v]
+            sa += _xlog2x(a + b) - _xlog2x(a) - _xlog2x(b)
+            q2 += 2 * a * b
+            sizes[u] = a + b
+            parent[v] = u
+            rows[v] = None
+        yield n, snn, sa, sb, q1, q2, q3
+
+
 def vi_by_threshold(ucm, gt, ignore_seg=[], ignore_gt=[], npoints=None,
                                                             nprocessors=None):
     """Compute the VI at every threshold of the provided UCM.
@@ -653,8 +844,8 @@ def vi_by_threshold(ucm, gt, ignore_seg=[], ignore_gt=[], npoints=None,
         The number of thresholds to sample. By default, all thresholds are
         sampled.
     nprocessors : int, optional
-        Number of processors to use for the parallel evaluation of different
-        thresholds.
+        Deprecated and ignored. The thresholds are evaluated in a single
+        incremental pass.
 
     Returns
     -------
@@ -664,20 +855,27 @@ def vi_by_threshold(ucm, gt, ignore_seg=[], ignore_gt=[], npoints=None,
             - the threshold used
             - the undersegmentation component of VI
             - the oversegmentation component of VI
+
+    Notes
+    -----
+    The segmentation at each threshold `t` is ``label(ucm < t)[0]``,
+    but it is never built: the table sums are updated as the regions
+    merge with increasing threshold. See ``_ucm_table_sums``.
     """
+    if nprocessors is not None:
+        warnings.warn('The nprocessors argument of vi_by_threshold is '
+                      'ignored and will be removed.', DeprecationWarning)
     ts = np.unique(ucm)[1:]
     if npoints is None:
         npoints = len(ts)
     if len(ts) > 2*npoints:
         ts = ts[np.arange(1, len(ts), len(ts)/npoints)]
-    if nprocessors == 1: # this should avoid pickling overhead
-        result = [split_vi_threshold((ucm, gt, ignore_seg, ignore_gt, t))
-                for t in ts]
-    else:
-        p = multiprocessing.Pool(nprocessors)
-        result = p.map(split_vi_threshold, 
-            ((ucm, gt, ignore_seg, ignore_gt, t) for t in ts))
-    return np.concatenate((ts[np.newaxis, :], np.array(result).T), axis=0)
+    result = np.zeros((2, len(ts)))
+    for i, (n, snn, sa, sb, _, _, _) in enumerate(
+                        _ucm_table_sums(ucm, gt, ts, ignore_seg, ignore_gt)):
+        # false merges, false splits
+        result[:, i] = [(sa - snn) / n, (sb - snn) / n]
+    return np.concatenate((ts[np.newaxis, :], result), axis=0)
 
 
 def rand_by_threshold(ucm, gt, npoints=None):
@@ -709,13 +907,16 @@ def rand_by_threshold(ucm, gt, npoints=None):
     if len(ts) > 2 * npoints:
         ts = ts[np.arange(1, len(ts), len(ts) / npoints)]
     result = np.zeros((2, len(ts)))
-    for i, t in enumerate(ts):
-        seg = label(ucm < t)[0]
-        result[0, i] = rand_index(seg, gt)
-        result[1, i] = adj_rand_index(seg, gt)
+    for i, (n, _, _, _, sum1, sum2, sum3) in enumerate(
+                                    _ucm_table_sums(ucm, gt, ts, [0], [0])):
+        a, b, c, d = _rand_values_from_sums(n, sum1, sum2, sum3)
+        result[0, i] = (a+d)/(a+b+c+d)
+        nk = a+b+c+d
+        result[1, i] = (nk*(a+d) - ((a+b)*(a+c) + (c+d)*(b+d)))/(
+            nk**2 - ((a+b)*(a+c) + (c+d)*(b+d)))
     return np.concatenate((ts[np.newaxis, :], result), axis=0)
 
-def adapted_rand_error(seg, gt, all_stats=False):
+def adapted_rand_error(seg, gt=None, all_stats=False):
     """Compute Adapted Rand error as defined by the SNEMI3D contest [1]
 
     Formula is given as 1 - the maximal F-score of the Rand index 
@@ -725,8 +926,11 @@ def adapted_rand_error(seg, gt, all_stats=False):
     Parameters
     ----------
     seg : np.ndarray
-        the segmentation to score, where each value is the label at that point
-    gt : np.ndarray, same shape as seg
+        the segmentation to score, where each value is the label at that point.
+        If `gt` is not given, a contingency table of the segmentation and
+        groundtruth (sparse.csc_matrix), *not* normalised and *not*
+        ignoring any labels.
+    gt : np.ndarray, same shape as seg, optional
         the groundtruth to score against, where each value is a label
     all_stats : boolean, optional
         whether to also return precision and recall as a 3-tuple with rand_error
@@ -746,28 +950,25 @@ def adapted_rand_error(seg, gt, all_stats=False):
     [1]: http://brainiac2.mit.edu/SNEMI3D/evaluation
     """
     # segA is truth, segB is query
-    segA = np.ravel(gt)
-    segB = np.ravel(seg)
-    n = segA.size
-
-    n_labels_A = np.amax(segA) + 1
-    n_labels_B = np.amax(segB) + 1
-
-    ones_data = np.ones(n)
-
-    p_ij = sparse.csr_matrix((ones_data, (segA[:], segB[:])), shape=(n_labels_A, n_labels_B))
+    if gt is None:
+        p_ij = seg.T.tocsr()
+    else:
+        p_ij = contingency_table(np.ravel(gt), np.ravel(seg), ignore_seg=[],
+                                 ignore_gt=[], norm=False).tocsr()
+    n = p_ij.sum()
+    n_labels_A, n_labels_B = p_ij.shape
 
     a = p_ij[1:n_labels_A,:]
     b = p_ij[1:n_labels_A,1:n_labels_B]
     c = p_ij[1:n_labels_A,0].todense()
-    d = np.array(b.todense()) ** 2
+    d = b.multiply(b)
 
     a_i = np.array(a.sum(1))
     b_i = np.array(b.sum(0))
 
     sumA = np.sum(a_i * a_i)
     sumB = np.sum(b_i * b_i) + (np.sum(c) / n)
-    sumAB = np.sum(d) + (np.sum(c) / n)
+    sumAB = d.sum() + (np.sum(c) / n)
 
     precision = sumAB / sumB
     recall = sumAB / sumA
@@ -1083,6 +1284,15 @@ def rand_values(cont_table):
     sum1 = (cont_table.multiply(cont_table)).sum()
     sum2 = (np.asarray(cont_table.sum(axis=1)) ** 2).sum()
     sum3 = (np.asarray(cont_table.sum(axis=0)) ** 2).sum()
+    return _rand_values_from_sums(n, sum1, sum2, sum3)
+
+
+def _rand_values_from_sums(n, sum1, sum2, sum3):
+    """Calculate the Rand values from the sums of a contingency table.
+
+    `n` is the table total, and `sum1`, `sum2` and `sum3` are the sums of
+    squares of its entries, row sums and column sums. See ``rand_values``.
+    """
     a = (sum1 - n)/2.0;
     b = (sum2 - sum1)/2
     c = (sum3 - sum1)/2
@@ -1167,6 +1377,106 @@ def fm_index(x, y=None):
     return a/(np.sqrt((a+b)*(a+c)))
 
 
+def h5_contingency_table(seg_fn, gt_fn, seg_group='stack', gt_group='stack',
+                         ignore_seg=[0], ignore_gt=[0], norm=True,
+                         chunk_size=64):
+    """Return the contingency table of two volumes stored in HDF5 files.
+
+    The volumes are read `chunk_size` planes at a time, along the first
+    axis, and the table of each chunk is added to the running table, so
+    that neither volume is ever fully in memory.
+
+    Parameters
+    ----------
+    seg_fn, gt_fn : string
+        The files containing the candidate and ground truth segmentations.
+    seg_group, gt_group : string, optional
+        The datasets within the files containing the volumes.
+    ignore_seg, ignore_gt, norm : optional
+        As in ``contingency_table``.
+    chunk_size : int, optional
+        The number of planes read at a time.
+
+    Returns
+    -------
+    cont : scipy.sparse.csc_matrix
+        The contingency table, as returned by ``contingency_table``.
+    """
+    cont = sparse.csc_matrix((1, 1))
+    with h5py.File(seg_fn, 'r') as fseg, h5py.File(gt_fn, 'r') as fgt:
+        seg, gt = fseg[seg_group], fgt[gt_group]
+        if seg.shape != gt.shape:
+            raise ValueError('Volume shapes differ: %s and %s' %
+                             (seg.shape, gt.shape))
+        for start in range(0, seg.shape[0], chunk_size):
+            chunk = contingency_table(seg[start:start + chunk_size],
+                                      gt[start:start + chunk_size],
+                                      ignore_seg, ignore_gt, norm=False)
+            cont = _add_tables(cont, chunk)
+    if norm:
+        cont /= float(cont.sum())
+    return cont
+
+
+def _add_tables(a, b):
+    """Sum two sparse tables, growing the smaller one as needed."""
+    a, b = a.tocoo(), b.tocoo()
+    shape = (max(a.shape[0], b.shape[0]), max(a.shape[1], b.shape[1]))
+    return sparse.csc_matrix((np.concatenate((a.data, b.data)),
+                              (np.concatenate((a.row, b.row)),
+                               np.concatenate((a.col, b.col)))), shape=shape)
+
+
+def _remove_labels(cont, ignore_seg, ignore_gt):
+    """Zero out the rows and columns of ignored labels in a table."""
+    keep_rows = np.ones(cont.shape[0])
+    keep_rows[[i for i in ignore_seg if 0 <= i < cont.shape[0]]] = 0
+    keep_cols = np.ones(cont.shape[1])
+    keep_cols[[j for j in ignore_gt if 0 <= j < cont.shape[1]]] = 0
+    cont = sparse.diags(keep_rows).dot(cont).dot(sparse.diags(keep_cols))
+    cont = sparse.csc_matrix(cont)
+    cont.eliminate_zeros()
+    return cont
+
+
+def evaluate_h5(seg_fn, gt_fn, seg_group='stack', gt_group='stack',
+                ignore_seg=[0], ignore_gt=[0], chunk_size=64):
+    """Compute all evaluation measures of HDF5 volumes, reading them in chunks.
+
+    A single contingency table, including all labels, is accumulated
+    with ``h5_contingency_table``, and every measure is computed from it.
+
+    Parameters
+    ----------
+    seg_fn, gt_fn : string
+        The files containing the candidate and ground truth segmentations.
+    seg_group, gt_group : string, optional
+        The datasets within the files containing the volumes.
+    ignore_seg, ignore_gt : list of int, optional
+        Labels ignored by all measures except the adapted Rand error,
+        which handles the 0 label itself.
+    chunk_size : int, optional
+        The number of planes read at a time.
+
+    Returns
+    -------
+    measures : dict
+        The values of ``vi``, ``split_vi``, ``rand_index``,
+        ``adj_rand_index``, ``fm_index`` and ``adapted_rand_error``,
+        keyed by function name.
+    """
+    cont = h5_contingency_table(seg_fn, gt_fn, seg_group, gt_group, [], [],
+                                norm=False, chunk_size=chunk_size)
+    cont_ignored = _remove_labels(cont, ignore_seg, ignore_gt)
+    measures = {'split_vi': split_vi(cont_ignored),
+                'rand_index': rand_index(cont_ignored),
+                'adj_rand_index': adj_rand_index(cont_ignored),
+                'fm_index': fm_index(cont_ignored),
+                'adapted_rand_error': adapted_rand_error(cont)}
+    measures['vi'] = measures['split_vi'].sum()
+    return measures
+
+
 def reduce_vi(fn_pattern='testing/%i/flat-single-channel-tr%i-%i-%.2f.lzf.h5',
         iterable=[(ts, tr, ts) for ts, tr in it.permutations(range(8), 2)],
         thresholds=np.arange(0, 1.01, 0.01)):
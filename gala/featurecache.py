@@ -0,0 +1,120 @@
+"""Cache of edge feature vectors stored in a single 2D array.
+
+Feature managers compute an edge's feature vector from the feature
+caches of the edge and of its two nodes. These only change when one of
+the nodes is merged, so the vectors can be reused until then. A
+``FeatureVectorCache`` stores them as rows of a preallocated array that
+grows as needed, and recycles the rows of invalidated edges.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class FeatureVectorCache(object):
+    """Store feature vectors by edge, invalidated by node.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        The initial number of rows to allocate.
+
+    Attributes
+    ----------
+    owner : object
+        The feature map that computed the cached vectors.
+    hits, misses : int
+        The number of lookups that found and did not find a vector.
+
+    Examples
+    --------
+    >>> cache = FeatureVectorCache()
+    >>> cache.set((1, 2), np.array([0.5, 1.0]))
+    >>> cache.get((1, 2))
+    array([ 0.5,  1. ])
+    >>> cache.invalidate_nodes([2])
+    >>> cache.get((1, 2)) is None
+    True
+    >>> sorted(cache.stats().items())
+    [('hits', 1), ('misses', 1), ('size', 0)]
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.owner = None
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def __len__(self):
+        return len(self.row_of)
+
+    def clear(self):
+        """Remove all vectors from the cache, keeping the hit counts."""
+        self.rows = None
+        self.row_of = {}
+        self.keys_of_node = {}
+        self.free_rows = []
+        self.num_rows = 0
+
+    def get(self, key):
+        """Return a copy of the vector stored for `key`, or ``None``.
+
+        Parameters
+        ----------
+        key : (int, int)
+            The edge, in the node order used to compute the vector.
+
+        Returns
+        -------
+        vector : 1D array of float, or None
+            The cached feature vector.
+        """
+        row = self.row_of.get(key)
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.rows[row].copy()
+
+    def set(self, key, vector):
+        """Store `vector` as the feature vector of edge `key`.
+
+        Vectors whose length differs from those already in the cache
+        are not stored.
+        """
+        vector = np.ravel(vector)
+        if self.rows is None:
+            self.rows = np.empty((self.capacity, len(vector)), np.double)
+        if vector.shape != self.rows.shape[1:]:
+            return
+        row = self.row_of.get(key)
+        if row is None:
+            row = self._new_row()
+            self.row_of[key] = row
+            for n in key:
+                self.keys_of_node.setdefault(n, set()).add(key)
+        self.rows[row] = vector
+
+    def invalidate_nodes(self, nodes):
+        """Remove the vectors of all edges incident to any of `nodes`."""
+        for n in nodes:
+            for key in self.keys_of_node.pop(n, ()):
+                self.free_rows.append(self.row_of.pop(key))
+                for m in key:
+                    if m != n:
+                        self.keys_of_node[m].discard(key)
+
+    def stats(self):
+        """Return the number of hits, misses, and cached vectors."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+    def _new_row(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        if self.num_rows == len(self.rows):
+            rows = np.empty((2 * len(self.rows),) + self.rows.shape[1:],
+                            self.rows.dtype)
+            rows[:self.num_rows] = self.rows
+            self.rows = rows
+        self.num_rows += 1
+        return self.num_rows - 1
@@ -1,7 +1,42 @@
 from __future__ import absolute_import
 import numpy as np
 
+from ..indexset import as_array
+
+
+def stack_indices(index_sets):
+    """Concatenate sets of voxel indices, labeling each by its position.
+
+    Parameters
+    ----------
+    index_sets : list of set of int
+        The voxel indices of each node or edge.
+
+    Returns
+    -------
+    idxs : array of int
+        The concatenated indices.
+    labels : array of int, same shape as `idxs`
+        The position in `index_sets` of the set each index came from.
+
+    Examples
+    --------
+    >>> idxs, labels = stack_indices([{4, 5}, set(), {1}])
+    >>> idxs.tolist(), labels.tolist()
+    ([4, 5, 1], [0, 0, 2])
+    """
+    arrays = [as_array(s) for s in index_sets]
+    if len(arrays) == 0:
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    labels = np.repeat(np.arange(len(arrays)), [len(a) for a in arrays])
+    return np.concatenate(arrays).astype(np.intp, copy=False), labels
+
+
 class Null(object):
+    # Features depend only on the two nodes and the edge between them, so
+    # they can be cached until one of the nodes is merged.
+    cacheable = True
+
     def __init__(self, *args, **kwargs):
         self.default_cache = 'feature-cache'
 
@@ -13,22 +48,37 @@ class Null(object):
 
     def compute_features(self, g, n1, n2=None):
         if n2 is None:
-            c1 = g.node[n1][self.default_cache]
+            c1 = self.node_cache(g, n1)
             return self.compute_node_features(g, n1, c1)
         if g.node[n1]['size'] > g.node[n2]['size']:
             n1, n2 = n2, n1 # smaller node first
-        c1, c2, ce = [d[self.default_cache] for d in 
-                            [g.node[n1], g.node[n2], g[n1][n2]]]
+        c1, c2, ce = (self.node_cache(g, n1), self.node_cache(g, n2),
+                      self.edge_cache(g, n1, n2))
         return np.concatenate((
             self.compute_node_features(g, n1, c1),
             self.compute_node_features(g, n2, c2),
             self.compute_edge_features(g, n1, n2, ce),
             self.compute_difference_features(g, n1, n2, c1, c2)
         ))
+    # Graphs with lazy feature caches only create them on first use.
+    def node_cache(self, g, n):
+        d = g.node[n]
+        if self.default_cache not in d:
+            d[self.default_cache] = self.create_node_cache(g, n)
+        return d[self.default_cache]
+    def edge_cache(self, g, n1, n2):
+        d = g[n1][n2]
+        if self.default_cache not in d:
+            d[self.default_cache] = self.create_edge_cache(g, n1, n2)
+        return d[self.default_cache]
     def create_node_cache(self, *args, **kwargs):
         return np.array([])
     def create_edge_cache(self, *args, **kwargs):
         return np.array([])
+    def create_node_caches(self, g, nodes):
+        return [self.create_node_cache(g, n) for n in nodes]
+    def create_edge_caches(self, g, edges):
+        return [self.create_edge_cache(g, n1, n2) for n1, n2 in edges]
     def update_node_cache(self, *args, **kwargs):
         pass
     def update_edge_cache(self, *args, **kwargs):
@@ -49,6 +99,10 @@ class Composite(Null):
     def __init__(self, children=[], *args, **kwargs):
         super(Composite, self).__init__()
         self.children = children
+
+    @property
+    def cacheable(self):
+        return all(child.cacheable for child in self.children)
  
     def write_fm(self, json_fm={}):
         for child in self.children:
@@ -60,6 +114,20 @@ class Composite(Null):
 
     def create_edge_cache(self, *args, **kwargs):
         return [c.create_edge_cache(*args, **kwargs) for c in self.children]
+
+    def create_node_caches(self, g, nodes):
+        caches = [[] for n in nodes]
+        for child in self.children:
+            for cache, c in zip(caches, child.create_node_caches(g, nodes)):
+                cache.append(c)
+        return caches
+
+    def create_edge_caches(self, g, edges):
+        caches = [[] for e in edges]
+        for child in self.children:
+            for cache, c in zip(caches, child.create_edge_caches(g, edges)):
+                cache.append(c)
+        return caches
     
     def update_node_cache(self, g, n1, n2, dst, src):
         for i, child in enumerate(self.children):
@@ -7,6 +7,9 @@ import networkx as nx
 from . import base
 
 class Manager(base.Null):
+    # features depend on the neighbors of each node
+    cacheable = False
+
     def __init__(self, *args, **kwargs):
         super(Manager, self).__init__()
 
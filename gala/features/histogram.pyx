@@ -64,6 +64,38 @@ class Manager(base.Null):
                 'either a 1-d or 2-d np.array of probabilities. '+
                 'Got %i-d np.array.'% vals.ndim)
 
+    def histograms(self, vals, labels, nlabels):
+        """Compute the histograms of many sets of values at once.
+
+        Parameters
+        ----------
+        vals : array of float, shape (N, C) or (N,)
+            The values of `N` voxels in `C` channels.
+        labels : array of int, shape (N,)
+            The set, in ``range(nlabels)``, that each voxel belongs to.
+        nlabels : int
+            The number of sets.
+
+        Returns
+        -------
+        hists : array of float, shape (nlabels, C, nbins)
+            The histogram of each set, as returned by
+            ``Manager.histogram``.
+        """
+        if vals.ndim == 1:
+            vals = vals[:, np.newaxis]
+        nchannels = vals.shape[1]
+        edges = np.linspace(self.minval, self.maxval, self.nbins + 1)
+        bins = np.digitize(vals, edges) - 1
+        bins[vals == self.maxval] = self.nbins - 1 # last bin is closed
+        valid = (bins >= 0) & (bins < self.nbins)
+        keys = ((labels[:, np.newaxis] * nchannels + np.arange(nchannels)) *
+                self.nbins + bins)
+        counts = np.bincount(keys[valid],
+                             minlength=nlabels * nchannels * self.nbins)
+        return counts.reshape((nlabels, nchannels, self.nbins)).astype(
+                                                                np.double)
+
     def percentiles_py(self, h, desired_percentiles):
         if h.ndim == 1 or any([i==1 for i in h.shape]): h = h.reshape((1,-1))
         h = h.T
@@ -118,6 +150,23 @@ class Manager(base.Null):
 
         return self.histogram(ar[edge_idxs,:])
 
+    def create_node_caches(self, g, nodes):
+        idxs, labels = base.stack_indices([g.extent(n) for n in nodes])
+        if self.oriented:
+            ar = g.max_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return list(self.histograms(ar[idxs], labels, len(nodes)))
+
+    def create_edge_caches(self, g, edges):
+        idxs, labels = base.stack_indices([g[n1][n2]['boundary']
+                                           for n1, n2 in edges])
+        if self.oriented:
+            ar = g.oriented_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return list(self.histograms(ar[idxs], labels, len(edges)))
+
     def update_node_cache(self, g, n1, n2, dst, src):
         dst += src
 
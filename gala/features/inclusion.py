@@ -3,6 +3,9 @@ import numpy as np
 from . import base
 
 class Manager(base.Null):
+    # features depend on the neighbors of each node
+    cacheable = False
+
     def __init__(self, *args, **kwargs):
         super(Manager, self).__init__()
 
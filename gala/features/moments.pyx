@@ -35,6 +35,40 @@ class Manager(base.Null):
         values = ar[idxs][...,np.newaxis]
         return (values ** np.arange(self.nmoments+1)).sum(axis=0).T
 
+    def bulk_moment_sums(self, ar, idxs, labels, nlabels):
+        """Compute the moment sums of many sets of voxels at once.
+
+        Parameters
+        ----------
+        ar : array of float, shape (M, C) or (M,)
+            The raveled probability map.
+        idxs : array of int, shape (N,)
+            The indices of the voxels in `ar`.
+        labels : array of int, shape (N,)
+            The set, in ``range(nlabels)``, that each voxel belongs to.
+        nlabels : int
+            The number of sets.
+
+        Returns
+        -------
+        sums : array of float, shape (nlabels, nmoments + 1, C)
+            The moment sums of each set, as returned by
+            ``Manager.compute_moment_sums``. (The last axis is absent if
+            `ar` is 1D.)
+        """
+        values = ar[idxs]
+        sums = np.empty((nlabels, self.nmoments + 1) + values.shape[1:])
+        for k in range(self.nmoments + 1):
+            powers = values ** k
+            if powers.ndim == 1:
+                sums[:, k] = np.bincount(labels, weights=powers,
+                                         minlength=nlabels)
+            else:
+                for c in range(powers.shape[1]):
+                    sums[:, k, c] = np.bincount(labels, weights=powers[:, c],
+                                                minlength=nlabels)
+        return sums
+
     def create_node_cache(self, g, n):
         node_idxs = list(g.extent(n))
         if self.oriented:
@@ -51,6 +85,23 @@ class Manager(base.Null):
             ar = g.non_oriented_probabilities_r
         return self.compute_moment_sums(ar, edge_idxs)
 
+    def create_node_caches(self, g, nodes):
+        idxs, labels = base.stack_indices([g.extent(n) for n in nodes])
+        if self.oriented:
+            ar = g.max_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return list(self.bulk_moment_sums(ar, idxs, labels, len(nodes)))
+
+    def create_edge_caches(self, g, edges):
+        idxs, labels = base.stack_indices([g[n1][n2]['boundary']
+                                           for n1, n2 in edges])
+        if self.oriented:
+            ar = g.oriented_probabilities_r
+        else:
+            ar = g.non_oriented_probabilities_r
+        return list(self.bulk_moment_sums(ar, idxs, labels, len(edges)))
+
     def update_node_cache(self, g, n1, n2, dst, src):
         dst += src
 
@@ -526,7 +526,8 @@ def apply_segmentation_map(superpixels, sp_to_body_map):
     segmentation : numpy ndarray, same shape as 'superpixels', int type
         The segmentation induced by the superpixels and map.
     """
-    forward_map = np.zeros(sp_to_body_map[:, 0].max() + 1,
+    # uint64 + int is a float in numpy, so convert the maximum to int
+    forward_map = np.zeros(int(sp_to_body_map[:, 0].max()) + 1,
                            sp_to_body_map.dtype)
     forward_map[sp_to_body_map[:, 0]] = sp_to_body_map[:, 1]
     segmentation = forward_map[superpixels]
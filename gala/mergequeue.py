@@ -5,7 +5,8 @@ from .iterprogress import NoProgressBar, StandardProgressBar
 
 class MergeQueue(object):
     def __init__(self, items=[], length=None, with_progress=False, 
-                                            prog_title='Agglomerating... '):
+                 prog_title='Agglomerating... ', compact_ratio=None,
+                 min_compact_size=1024):
         if length is None:
             self.num_valid_items = len(items)
         else:
@@ -14,6 +15,10 @@ class MergeQueue(object):
         self.q = items
         heapify(self.q)
         self.is_null_queue = len(items) == 0
+        # drop invalid items once the heap is `compact_ratio` times
+        # larger than the number of valid items (None: never)
+        self.compact_ratio = compact_ratio
+        self.min_compact_size = min_compact_size
         if with_progress:
             self.pbar = StandardProgressBar(prog_title)
         else:
@@ -57,11 +62,154 @@ class MergeQueue(object):
     def push_next(self, item):
         heappush(self.q, item)
         self.num_valid_items += 1
+        if self.compact_ratio is not None:
+            self.maybe_compact()
 
     def invalidate(self, item):
         if item[1]:
             self.num_valid_items -= 1
         item[1] = False
 
+    def update(self, item, new_item):
+        """Replace `item` by `new_item` and return the item now queued."""
+        self.invalidate(item)
+        self.push(new_item)
+        return new_item
+
+    def maybe_compact(self):
+        """Compact the queue if it has too many invalid items."""
+        total = len(self.q)
+        if total > self.min_compact_size and \
+                total > self.compact_ratio * self.num_valid_items:
+            self.compact()
+
+    def compact(self):
+        """Remove all invalid items from the underlying heap."""
+        self.q[:] = [item for item in self.q if item[1]]
+        heapify(self.q)
+
+    def _total_len(self):
+        return len(self.q)
+
+
+class IndexedMergeQueue(object):
+    """A merge queue with in-place priority updates and removal.
+
+    This has the same interface as ``MergeQueue``, but rather than
+    lazily marking items invalid and leaving them in the heap, items are
+    removed from the heap as soon as they are invalidated, and updated
+    items are moved to their new position. The heap thus only ever
+    contains valid items, and all operations are O(log n).
+
+    Items are lists of the form ``[priority, valid, n1, n2]``. They are
+    tracked by identity, so their node ids can be changed (for example
+    when a node is renamed) as long as the ordering is not affected.
+    """
+    def __init__(self, items=[], length=None, with_progress=False,
+                 prog_title='Agglomerating... '):
+        self.q = [item for item in items if item[1]]
+        heapify(self.q)
+        self.positions = dict((id(item), i) for i, item in enumerate(self.q))
+        self.original_length = len(self.q) if length is None else length
+        self.is_null_queue = len(items) == 0
+        if with_progress:
+            self.pbar = StandardProgressBar(prog_title)
+        else:
+            self.pbar = NoProgressBar()
+
+    def __len__(self):
+        return len(self.q)
+
+    def finish(self):
+        self.pbar.finish()
+
+    def is_empty(self):
+        return len(self.q) == 0
+
+    def peek(self):
+        return self.q[0]
+
+    def pop(self):
+        self.pop = self.pop_no_start
+        self.pbar.start(self.original_length)
+        return self.pop_no_start()
+
+    def pop_no_start(self):
+        if len(self.q) == 0:
+            raise IndexError('pop from empty merge queue')
+        item = self.q[0]
+        self.invalidate(item)
+        self.pbar.update_i(self.original_length - len(self.q))
+        return item
+
+    def push(self, item):
+        self.is_null_queue = False
+        self.q.append(item)
+        self.positions[id(item)] = len(self.q) - 1
+        self._sift_up(len(self.q) - 1)
+
+    def invalidate(self, item):
+        """Mark `item` as invalid and remove it from the queue."""
+        item[1] = False
+        i = self.positions.pop(id(item), None)
+        if i is None:
+            return
+        last = self.q.pop()
+        if i < len(self.q):
+            self.q[i] = last
+            self.positions[id(last)] = i
+            self._sift(i)
+
+    def update(self, item, new_item):
+        """Move `item` to the priority of `new_item`, and return it.
+
+        If `item` is no longer in the queue, `new_item` is pushed and
+        returned instead.
+        """
+        i = self.positions.get(id(item))
+        if i is None:
+            self.push(new_item)
+            return new_item
+        item[:] = new_item
+        self._sift(i)
+        return item
+
+    def _sift(self, i):
+        if i > 0 and self.q[i] < self.q[(i - 1) // 2]:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def _sift_up(self, i):
+        q, positions = self.q, self.positions
+        item = q[i]
+        while i > 0:
+            parent = (i - 1) // 2
+            if not item < q[parent]:
+                break
+            q[i] = q[parent]
+            positions[id(q[i])] = i
+            i = parent
+        q[i] = item
+        positions[id(item)] = i
+
+    def _sift_down(self, i):
+        q, positions = self.q, self.positions
+        n = len(q)
+        item = q[i]
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            if child + 1 < n and q[child + 1] < q[child]:
+                child += 1
+            if not q[child] < item:
+                break
+            q[i] = q[child]
+            positions[id(q[i])] = i
+            i = child
+        q[i] = item
+        positions[id(item)] = i
+
     def _total_len(self):
         return len(self.q)
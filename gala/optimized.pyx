@@ -1,5 +1,7 @@
 import numpy as np
 cimport numpy as np
+cimport cython
+from scipy import ndimage as nd
 
 def despeckle_watershed(ws, in_place=True):
     """ Function to clean up dots in an initial oversegmentation. 
@@ -62,21 +64,22 @@ cdef _despeckle_2d_watershed(long[:,:] ws):
             ws[ii,jj] = replacements[ws[ii,jj]]
     return ws
 
-def flood_fill(im, start, acceptable, limits=None, raveled=False):
-    """ Find all connected points in a 3D volume.
+def flood_fill(im, start, acceptable, limits=None, raveled=False,
+               connectivity=1):
+    """ Find all connected points in an nD volume.
 
     Starting from a given point, this function floods into all adjacent
     points that have an acceptable label.
 
     Parameters
     ----------
-    im : 3D ndarray of longs
+    im : ndarray of int
         This is the volume in which the flood fill will fill. Each voxel's
         value is its label and its indices are its position.
-    start : 1D ndarray of longs
+    start : 1D array-like of int
         This gives the position of the first point from which the flood fill 
-        will begin. must be length 3.
-    acceptable : 1D ndarray of longs
+        will begin. Its length must be ``im.ndim``.
+    acceptable : 1D array-like of int
         As the flood fills, each pixel is checked to see if its value is in
         this list. the flood fill continues into that pixel iff it is.
     limits : 2D ndarray of longs, optional
@@ -87,168 +90,72 @@ def flood_fill(im, start, acceptable, limits=None, raveled=False):
     raveled : boolean, optional
         Specifies whether to return the flooded pixels as coordinates or as
         raveled indices.
+    connectivity : int in {1, ..., `im.ndim`}, optional
+        The maximum number of dimensions along which two points can
+        differ and still be considered adjacent.
 
     Returns
     -------
     matches : ndarray
         either a 1D array of raveled indices of pixels in im, or a 
         2D ndarray where each row is the coordinates of a pixel.
-    """
-    cdef np.ndarray[np.int_t, ndim=2] matches
-    if im.ndim == 3:
-        a = np.array(acceptable)
-        s = np.array(start)
-        if limits == None:
-            limits = np.array([[0,im.shape[0]-1],[0,im.shape[1]-1],[0,im.shape[2]-1]])
-        matches = _flood_fill_3d(im, s, a, limits)
-        if _list_match(a, im[s[0], s[1], s[2]]) == -1:
-            return np.array([])
-        if raveled:
-            formatted = matches.T
-            return np.ravel_multi_index(formatted, im.shape)
-        else:
-            return matches
-    else: raise ValueError("flood fill volume must be 3d!")
 
-cdef inline _row_match(long[:,:] rows, long[:] query, long limit):
-    """ Fast check if the `query` array is a row in `rows`
-    
-    Parameters
-    ----------
-    rows : ndarray, 2 dimensions, type long
-        Each row represents a unique potential match.
-    query : ndarray, 1 dimension, type long
-        The group of numbers we wish to know if appears in `rows`
-    limit : long
-        Only searches the first `limit` many rows.
-
-    Returns
-    -------
-    rr : long
-        The row of the first occurence of `query`, or -1 if not found.
+    Notes
+    -----
+    The fill runs in time linear in the size of the region within
+    `limits`: acceptable voxels are marked in a mask, which is cleared
+    as voxels are visited, and the queue of visited voxels is a flat
+    array of raveled indices.
     """
-    cdef int rr, jj, match
-    for rr in range(limit):
-        match = 1
-        for jj in range(rows.shape[1]):
-            if query[jj] != rows[rr,jj]:
-                match = 0
-                break
-        if match == 1: return rr
-    return -1
+    im = np.asarray(im)
+    start = np.asarray(start, dtype=np.intp)
+    if limits is None:
+        limits = np.array([[0, s - 1] for s in im.shape])
+    limits = np.asarray(limits, dtype=np.intp)
+    sub = im[tuple(slice(lo, hi + 1) for lo, hi in limits)]
+    # pad the mask with unacceptable voxels so neighbors need no bounds check
+    shape = tuple(np.array(sub.shape) + 2)
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[tuple([slice(1, -1)] * im.ndim)] = np.in1d(
+                                sub.ravel(), acceptable).reshape(sub.shape)
+    start_idx = np.ravel_multi_index(tuple(start - limits[:, 0] + 1), shape)
+    mask_r = mask.ravel()
+    if not mask_r[start_idx]:
+        return np.array([])
+    strides = np.cumprod((1,) + shape[:0:-1])[::-1]
+    footprint = nd.generate_binary_structure(im.ndim, connectivity)
+    steps = np.transpose(np.nonzero(footprint)) - 1
+    steps = steps[np.any(steps != 0, axis=1)]
+    offsets = np.ascontiguousarray(steps.dot(strides), dtype=np.intp)
+    out = np.empty(np.count_nonzero(mask_r), dtype=np.intp)
+    n = _flood_fill_raveled(mask_r, offsets, start_idx, out)
+    coords = np.transpose(np.unravel_index(out[:n], shape)) - 1 + limits[:, 0]
+    if raveled:
+        return np.ravel_multi_index(tuple(coords.T), im.shape)
+    else:
+        return coords
 
-cdef inline _list_match(long[:] vals, long query):
-    """ Fast check if a long is in a list of longs
-    
-    Parameters
-    ----------
-    vals : ndarray, 1 dimension, type long
-        The list of acceptable values.
-    query : long
-        The value we wish to know whether is in vals.
-    
-    Returns
-    -------
-    jj : long
-        The index of the first occurence of query in vals,
-        or -1 if not found.
-    """
-    cdef int jj
-    for jj in range(vals.shape[0]):
-        if vals[jj] == query: return jj
-    return -1
 
-cdef _flood_fill_3d(long[:,:,:] im, long[:] start, long[:] acceptable, long[:,:] limits):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _flood_fill_raveled(np.uint8_t[::1] mask,
+                                    Py_ssize_t[::1] offsets, Py_ssize_t start,
+                                    Py_ssize_t[::1] out) nogil:
     """ Workhorse function for flood_fill, see its documentation.
-    Assumes im[start] is in acceptable and start is within limits. """
-    cdef int frontier_size = 1
-    cdef int matches_size = 1
-    cdef int starting_size = 5000
-    cdef int ndim = im.ndim
-    cdef int in_matches, in_acceptable, base_point_ii, p_ii, new_frontier_size, jj
-    cdef np.ndarray[np.int_t, ndim=2] adjacent
-    cdef np.ndarray[np.int_t, ndim=2] matches =      np.zeros([starting_size, ndim], dtype=np.int)
-    cdef np.ndarray[np.int_t, ndim=2] frontier =     np.empty([starting_size, ndim], dtype=np.int)
-    cdef np.ndarray[np.int_t, ndim=2] new_frontier = np.empty([starting_size, ndim], dtype=np.int)
-    cdef np.ndarray[np.int_t, ndim=1] base_point, p
 
-    for jj in range(ndim):
-        frontier[0,jj] = start[jj]
-        matches[0,jj] = start[jj]
-    while frontier_size > 0:
-        new_frontier_size = 0
-        for base_point_ii in range(frontier_size):
-            base_point = frontier[base_point_ii]
-            adjacent = _adjacent_points(base_point, limits)
-            for p_ii in range(adjacent.shape[0]):
-                p = adjacent[p_ii]
-                if _list_match(p, -1) != -1:
-                    continue
-                if _row_match(matches, p, matches_size) > -1:
-                    continue
-                if _list_match(acceptable, im[p[0],p[1],p[2]]) == -1:
-                    continue
-                new_frontier[new_frontier_size] = p
-                matches[matches_size] = p
-                matches_size += 1
-                new_frontier_size += 1
-                if matches_size >= matches.shape[0]:
-                    matches = _expand_2darray(matches)
-                if new_frontier_size >= new_frontier.shape[0]:
-                    new_frontier = _expand_2darray(new_frontier)
-                    frontier = _expand_2darray(frontier)
-        for p_ii in range(new_frontier_size):
-            for jj in range(new_frontier.shape[1]):
-                frontier[p_ii,jj] = new_frontier[p_ii, jj]
-        frontier_size = new_frontier_size
-    return matches[0:matches_size, :]
-
- 
-cdef np.ndarray[np.int_t, ndim=2] _expand_2darray(long[:,:] a):
-    """ Double the number of rows in a matrix and copy over the existing values
-    """
-    cdef int ii,jj
-    cdef np.ndarray[np.int_t, ndim=2] expanded = np.zeros([a.shape[0] * 2, a.shape[1]], dtype=np.int)
-    for ii in range(a.shape[0]):
-        for jj in range(a.shape[1]):
-            expanded[ii,jj] = a[ii,jj]
-    return expanded
-
-
-cdef np.ndarray[np.int_t, ndim=2] _adjacent_points(long[:] point, long[:,:] limits):
-    """ Get all adjacent points to point that fall within limits. 
-        
-    Parameters
-    ----------
-    point : ndarray, 1 dimension, type long
-        the coordinates of an n-dimensional point    
-    limits : ndarray, 2 dimensions, type long
-        point.shape[0] rows, 2 columns, each row of this array represents the
-        lower and upper (inclusive) bounds of acceptable values for
-        points that are returned.
-
-    Returns
-    -------
-    adjacent : ndarray, 2 dimensions, type long
-        2 rows for each "dimension" of point, one column for each dimension
-        Each row represents an adjacent points to `point`. Invalid points are
-        left as -1 across all columns.
-    """
-    cdef int dimensions = point.shape[0]
-    cdef int variants = dimensions * 2
-    cdef int v = -1
-    cdef int d, s, new,ii
-    cdef int[2] shifts
-    cdef np.ndarray[np.int_t, ndim=2] adjacent = np.ones([variants, dimensions], dtype=np.int)*-1
-    shifts[0] = -1
-    shifts[1] = 1
-    for d in range(dimensions):
-        for s in shifts:
-            v += 1
-            new = point[d] + s
-            if new < limits[d,0] or new > limits[d,1]:
-                continue
-            for ii in range(dimensions):
-                adjacent[v,ii] = point[ii]
-            adjacent[v, d] = new
-    return adjacent
+    Flood `mask` from `start`, clearing visited points and writing their
+    raveled indices to `out`, which doubles as the queue. The border of
+    `mask` must be 0. Return the number of points found. """
+    cdef Py_ssize_t head = 0, tail = 1, point, neighbor, jj
+    mask[start] = 0
+    out[0] = start
+    while head < tail:
+        point = out[head]
+        head += 1
+        for jj in range(offsets.shape[0]):
+            neighbor = point + offsets[jj]
+            if mask[neighbor]:
+                mask[neighbor] = 0
+                out[tail] = neighbor
+                tail += 1
+    return tail
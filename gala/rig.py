@@ -0,0 +1,199 @@
+"""Region intersection graph between segments and a ground truth.
+
+``agglo.Rag`` tracks the overlap of its segments with a ground truth
+segmentation, as a contingency table with one row per node. Storing it
+as a dense array costs memory proportional to the number of segments
+times the number of ground truth bodies, and merging two rows of a
+sparse matrix is slow. A ``Rig`` stores each row as a sorted array of
+the ground truth bodies it overlaps and a matching array of overlaps.
+Merging two rows sorts their concatenated columns, taking
+O(nnz log nnz) time for rows with nnz entries in total, and leaves all
+other rows untouched.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+from scipy import sparse
+
+
+_EMPTY_ROW = (np.zeros(0, np.int64), np.zeros(0, float))
+
+
+class Rig(object):
+    """A contingency table stored as a dictionary of sparse rows.
+
+    Parameters
+    ----------
+    table : array or scipy.sparse matrix, shape (M, N), optional
+        The initial table. Row `i` becomes the row of node `i`. Rows
+        without nonzero entries are not stored.
+
+    Attributes
+    ----------
+    rows : dict of int to (array of int, array of float)
+        The sorted columns and the values of the nonzero entries of
+        each row.
+    ncols : int
+        The number of columns of the table.
+
+    Examples
+    --------
+    >>> rig = Rig(np.array([[0, 1, 0], [0, 2, 1], [0, 0, 0]]))
+    >>> rig.merge(0, 1, 3)
+    ((array([1]), array([ 1.])), (array([1, 2]), array([ 2.,  1.])))
+    >>> rig[3]
+    (array([1, 2]), array([ 3.,  1.]))
+    >>> rig.best(3), rig.best(2)
+    (array([1]), array([0, 1, 2]))
+    >>> rig.todense()
+    array([[ 0.,  0.,  0.],
+           [ 0.,  0.,  0.],
+           [ 0.,  0.,  0.],
+           [ 0.,  3.,  1.]])
+    """
+    def __init__(self, table=None):
+        self.rows = {}
+        self.ncols = 0
+        if table is not None:
+            table = sparse.csr_matrix(table, dtype=float)
+            table.eliminate_zeros()
+            table.sort_indices()
+            self.ncols = table.shape[1]
+            nz = np.flatnonzero(np.diff(table.indptr))
+            columns = np.split(table.indices.astype(np.int64),
+                               table.indptr[1:-1])
+            values = np.split(table.data, table.indptr[1:-1])
+            self.rows = dict((int(i), (columns[i], values[i])) for i in nz)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, n):
+        return n in self.rows
+
+    def __getitem__(self, n):
+        """Return the columns and values of row `n`, possibly empty."""
+        return self.rows.get(n, _EMPTY_ROW)
+
+    def values(self, n):
+        """Return the nonzero values of row `n`."""
+        return self[n][1]
+
+    def merged_row(self, n1, n2):
+        """Return the sum of rows `n1` and `n2`, without storing it.
+
+        Parameters
+        ----------
+        n1, n2 : int
+            The rows to add.
+
+        Returns
+        -------
+        columns : array of int
+            The sorted columns of the nonzero entries of the sum.
+        values : array of float
+            The values of the entries.
+        """
+        (c1, v1), (c2, v2) = self[n1], self[n2]
+        if len(c1) == 0 or len(c2) == 0:
+            return (c2, v2) if len(c1) == 0 else (c1, v1)
+        columns, idxs = np.unique(np.concatenate((c1, c2)),
+                                  return_inverse=True)
+        values = np.bincount(idxs, np.concatenate((v1, v2)),
+                             minlength=len(columns))
+        return columns, values
+
+    def merge(self, n1, n2, new):
+        """Replace rows `n1` and `n2` by their sum, as row `new`.
+
+        Parameters
+        ----------
+        n1, n2 : int
+            The rows to merge.
+        new : int
+            The row of the sum. It may be one of `n1` and `n2`.
+
+        Returns
+        -------
+        row1, row2 : (array of int, array of float)
+            The merged rows. Pass them to ``unmerge`` to undo the merge.
+        """
+        row = self.merged_row(n1, n2)
+        row1 = self.rows.pop(n1, _EMPTY_ROW)
+        row2 = self.rows.pop(n2, _EMPTY_ROW)
+        if len(row[0]) > 0:
+            self.rows[new] = row
+        return row1, row2
+
+    def unmerge(self, new, n1, n2, row1, row2):
+        """Undo ``merge(n1, n2, new)``, given the rows it returned."""
+        self.rows.pop(new, None)
+        for n, row in [(n1, row1), (n2, row2)]:
+            if len(row[0]) > 0:
+                self.rows[n] = row
+
+    def best(self, n):
+        """Return the columns of the largest entries of row `n`.
+
+        An empty row is equally close to every column, so all columns
+        are returned, as for a row of zeros in a dense table.
+        """
+        columns, values = self[n]
+        if len(columns) == 0:
+            return np.arange(self.ncols)
+        return columns[values == values.max()]
+
+    def argmax(self, n):
+        """Return the column of the largest entry of row `n`, or 0."""
+        columns, values = self[n]
+        return columns[values.argmax()] if len(columns) > 0 else 0
+
+    def split_vi(self):
+        """Return the conditional entropies of the normalized table.
+
+        Returns
+        -------
+        sv : array of float, shape (2,)
+            H(Y|X) and H(X|Y), with X the rows and Y the columns, as
+            computed by ``evaluate.split_vi``.
+        """
+        if len(self.rows) == 0:
+            return np.zeros(2)
+        columns = np.concatenate([c for c, v in self.rows.values()])
+        values = np.concatenate([v for c, v in self.rows.values()])
+        total = values.sum()
+        values = values / total
+        px = np.array([v.sum() for c, v in self.rows.values()]) / total
+        py = np.bincount(columns, values)
+        sxy, sx, sy = [np.sum(p[p > 0] * np.log2(p[p > 0]))
+                       for p in [values, px, py]]
+        return np.array([sx - sxy, sy - sxy])
+
+    def tocsr(self, shape=None):
+        """Return the table as a ``scipy.sparse.csr_matrix``.
+
+        Parameters
+        ----------
+        shape : (int, int), optional
+            The shape of the matrix. By default, it has one row past
+            the largest stored row and ``ncols`` columns.
+
+        Returns
+        -------
+        table : scipy.sparse.csr_matrix
+            The table.
+        """
+        ids = np.array(sorted(self.rows), np.int64)
+        if shape is None:
+            shape = (ids[-1] + 1 if len(ids) > 0 else 0, self.ncols)
+        lengths = np.zeros(shape[0], np.int64)
+        lengths[ids] = [len(self.rows[i][0]) for i in ids]
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        rows = [self.rows[i] for i in ids] or [_EMPTY_ROW]
+        columns = np.concatenate([c for c, v in rows])
+        values = np.concatenate([v for c, v in rows])
+        return sparse.csr_matrix((values, columns, indptr), shape=shape)
+
+    def todense(self, shape=None):
+        """Return the table as a dense array. See ``tocsr``."""
+        return self.tocsr(shape).toarray()
@@ -152,12 +152,29 @@ def gen_supervoxels(options, prediction_file, master_logger):
     return supervoxels, prediction
 
 
-def agglomeration(options, agglom_stack, supervoxels, prediction, 
-        image_stack, session_location, sp_outs, master_logger):
-    
+def threshold_maps(options, agglom_stack, supervoxels, master_logger):
+    """Agglomerate to each segmentation threshold in turn.
+
+    Yields each threshold with the superpixel to body map at that
+    threshold, leaving the stack agglomerated to the threshold until
+    the next map is requested. A Rag is agglomerated in a single sweep,
+    without building a segmentation volume per threshold.
+    """
     seg_thresholds = sorted(options.segmentation_thresholds)
+    if not options.use_neuroproof:
+        master_logger.info("Starting agglomeration sweep with " +
+            str(agglom_stack.number_of_nodes()))
+        for threshold, transforms in \
+                agglom_stack.agglomerate_sweep(seg_thresholds):
+            master_logger.info("Finished agglomeration to threshold " + str(threshold)
+                + " with " + str(agglom_stack.number_of_nodes()))
+            if options.inclusion_removal:
+                inclusion_removal(agglom_stack, master_logger)
+                transforms = agglom_stack.get_sp_to_body_map()
+            yield threshold, transforms
+        return
     for threshold in seg_thresholds:
-        if threshold != 0 or not options.use_neuroproof:
+        if threshold != 0:
             master_logger.info("Starting agglomeration to threshold " + str(threshold)
                 + " with " + str(agglom_stack.number_of_nodes()))
             agglom_stack.agglomerate(threshold)
@@ -167,16 +184,23 @@ def agglomeration(options, agglom_stack, supervoxels, prediction,
             if options.inclusion_removal:
                 inclusion_removal(agglom_stack, master_logger)
 
-        segmentation = agglom_stack.get_segmentation()     
+        segmentation = agglom_stack.get_segmentation()
+        yield threshold, imio.compute_sp_to_body_map(supervoxels, segmentation)
+
 
+def agglomeration(options, agglom_stack, supervoxels, prediction, 
+        image_stack, session_location, sp_outs, master_logger):
+    
+    for threshold, transforms in threshold_maps(options, agglom_stack,
+                                                supervoxels, master_logger):
         if options.h5_output:
+            segmentation = agglom_stack.get_segmentation()
             imio.write_image_stack(segmentation,
                 session_location+"/agglom-"+str(threshold)+".lzf.h5", compression='lzf')
           
         
         md5hex = hashlib.md5(' '.join(sys.argv)).hexdigest()
         file_base = os.path.abspath(session_location)+"/seg_data/seg-"+str(threshold) + "-" + md5hex + "-"
-        transforms = imio.compute_sp_to_body_map(supervoxels, segmentation)
         seg_loc = file_base +"v1.h5"
         if not os.path.exists(session_location+"/seg_data"):
             os.makedirs(session_location+"/seg_data")
@@ -0,0 +1,147 @@
+"""Union-find map from supervoxels to the segments containing them.
+
+``agglo.Rag`` records its merges in an ultrametric tree, from which a
+supervoxel-to-segment map can be computed, but only by walking the
+whole tree. A ``UnionFind`` is updated with every merge and finds the
+current segment of any supervoxel in near-constant time, using union by
+size and path compression.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+
+class UnionFind(object):
+    """Track the segment containing each supervoxel label.
+
+    Parameters
+    ----------
+    labels : iterable of int, optional
+        The supervoxel labels, each initially its own segment, with the
+        same id as the label. Other labels up to the largest one map to
+        segment 0.
+
+    Examples
+    --------
+    >>> uf = UnionFind([1, 2, 3, 4])
+    >>> uf.union(1, 2, 5)
+    >>> uf.union(5, 4, 6)
+    >>> uf[[0, 1, 2, 3, 4]]
+    array([0, 6, 6, 3, 6])
+    >>> uf[2]
+    6
+    >>> uf.assign([(5, [1, 2]), (4, [4])])
+    >>> uf.get_map()
+    array([0, 5, 5, 3, 4])
+    """
+    def __init__(self, labels=()):
+        labels = np.fromiter(labels, dtype=np.int64)
+        size = labels.max() + 1 if len(labels) > 0 else 1
+        self.parent = np.arange(size)
+        self.size = np.ones(size, np.int64)
+        self.segment = np.zeros(size, np.int64)
+        self.segment[labels] = labels
+        self.root_of = dict(zip(labels.tolist(), labels.tolist()))
+
+    def __len__(self):
+        return len(self.root_of)
+
+    def __getitem__(self, labels):
+        """Return the current segment of each of `labels`."""
+        return self.segment[self.find(labels)]
+
+    def find(self, labels):
+        """Return the representative label of the set of each of `labels`.
+
+        Parameters
+        ----------
+        labels : int or array-like of int
+            The supervoxel labels to look up.
+
+        Returns
+        -------
+        roots : int or array of int
+            The representative of each label, compressing the paths
+            from the labels to their representatives along the way.
+        """
+        if np.isscalar(labels):
+            root = labels
+            while self.parent[root] != root:
+                root = self.parent[root]
+            while self.parent[labels] != root:
+                self.parent[labels], labels = root, self.parent[labels]
+            return root
+        labels = np.asarray(labels)
+        roots = self.parent[labels]
+        while True:
+            grandparents = self.parent[roots]
+            if np.all(grandparents == roots):
+                break
+            roots = grandparents
+        self.parent[labels] = roots
+        return roots
+
+    def union(self, s1, s2, new):
+        """Merge segments `s1` and `s2` into a segment with id `new`.
+
+        Parameters
+        ----------
+        s1, s2 : int
+            The ids of the segments being merged.
+        new : int
+            The id of the merged segment.
+
+        Returns
+        -------
+        None
+        """
+        r1, r2 = self.root_of.pop(s1), self.root_of.pop(s2)
+        if self.size[r1] < self.size[r2]:
+            r1, r2 = r2, r1
+        self.parent[r2] = r1
+        self.size[r1] += self.size[r2]
+        self.segment[r1] = new
+        self.root_of[new] = r1
+
+    def assign(self, parts):
+        """Make segments out of the given sets of labels.
+
+        The segments currently containing the labels are removed, so
+        each of them must be entirely covered by `parts`. This undoes
+        ``union``, in time proportional to the number of labels.
+
+        Parameters
+        ----------
+        parts : iterable of (int, list of int)
+            The id of each new segment and its supervoxel labels.
+
+        Returns
+        -------
+        None
+        """
+        parts = [(s, np.asarray(labels, dtype=np.int64))
+                 for s, labels in parts]
+        for _, labels in parts:
+            for old in np.unique(self[labels]):
+                self.root_of.pop(old, None)
+        for s, labels in parts:
+            root = labels[0]
+            self.parent[labels] = root
+            self.size[root] = len(labels)
+            self.segment[root] = s
+            self.root_of[s] = root
+
+    def get_map(self):
+        """Return an array mapping every label to its current segment.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        forward_map : array of int
+            The segment of each label, or 0 for labels that are not
+            supervoxels.
+        """
+        return self[np.arange(len(self.parent))]
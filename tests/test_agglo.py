@@ -6,10 +6,12 @@ from six.moves import range
 D = os.path.dirname(os.path.abspath(__file__)) + '/'
 
 import numpy as np
-from numpy.testing import assert_equal, assert_allclose
+from numpy.testing import assert_equal, assert_allclose, assert_raises
 
 from gala import agglo
 from gala import evaluate as ev
+from gala import features
+from gala import imio
 
 
 test_idxs = list(range(6))
@@ -76,6 +78,402 @@ def test_mito():
                     err_msg='Mito merge failed')
 
 
+def _graph_attributes(g):
+    nodes = g.nodes()
+    sizes = [g.node[n].get('size') for n in nodes]
+    boundaries = [(u, v, sorted(g[u][v]['boundary'])) for u, v in g.edges()]
+    return nodes, sizes, boundaries
+
+
+def test_vectorized_build():
+    for ws in wss:
+        for connectivity in range(1, ws.ndim + 1):
+            for shared in [True, False]:
+                g1, g2 = [agglo.Rag(ws, connectivity=connectivity,
+                                    allow_shared_boundaries=shared,
+                                    vectorized_build=vec)
+                          for vec in [False, True]]
+                assert_equal(_graph_attributes(g1), _graph_attributes(g2))
+                if not shared:
+                    assert_equal(g1.ignored_boundary, g2.ignored_boundary)
+
+
+def test_parallel_build():
+    chunk_size = agglo._GRAPH_BUILD_CHUNK_SIZE
+    agglo._GRAPH_BUILD_CHUNK_SIZE = 8 # split toy volumes into many slabs
+    try:
+        for ws in wss[:3]:
+            for shared in [True, False]:
+                g1, g2 = [agglo.Rag(ws, allow_shared_boundaries=shared,
+                                    n_jobs=n_jobs) for n_jobs in [1, 2]]
+                assert_equal(g1.nodes(), g2.nodes())
+                assert_equal(g1.edges(), g2.edges())
+                assert_equal(_graph_attributes(g1), _graph_attributes(g2))
+                if not shared:
+                    assert_equal(g1.ignored_boundary, g2.ignored_boundary)
+    finally:
+        agglo._GRAPH_BUILD_CHUNK_SIZE = chunk_size
+
+
+def test_array_boundary_backend():
+    for i in [1, 3]:
+        g1, g2 = [agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+                            normalize_probabilities=True,
+                            boundary_backend=backend)
+                  for backend in ['set', 'array']]
+        assert all(isinstance(g2[u][v]['boundary'], agglo.IndexSet)
+                   for u, v in g2.edges())
+        nbytes1, nbytes2 = g1.boundary_nbytes(), g2.boundary_nbytes()
+        assert all(nbytes2[e] < nbytes1[e] for e in nbytes1)
+        for g in [g1, g2]:
+            g.agglomerate(0.5)
+        assert_equal(g1.get_segmentation(), g2.get_segmentation())
+        assert_equal(_graph_attributes(g1), _graph_attributes(g2))
+
+
+def test_merge_queue_types():
+    for i in [1, 3]:
+        g1, g2, g3 = [agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+                                normalize_probabilities=True, **kwargs)
+                      for kwargs in [{}, {'merge_queue_type': 'indexed'},
+                                     {'merge_queue_compact_ratio': 1.0}]]
+        for g in [g1, g2, g3]:
+            g.agglomerate(0.5)
+        assert_equal(g1.get_segmentation(), g2.get_segmentation())
+        assert_equal(g1.get_segmentation(), g3.get_segmentation())
+        assert_equal(g2.merge_queue._total_len(), len(g2.merge_queue))
+        assert all(qitem[1] for qitem in g2.merge_queue.q)
+
+
+def test_merge_queue_compaction():
+    q = agglo.MergeQueue([], compact_ratio=2.0, min_compact_size=4)
+    items = [[float(p), True, p, p + 1] for p in range(10)]
+    for item in items:
+        q.push(item)
+    for item in items[:7]:
+        q.invalidate(item)
+    assert_equal(q._total_len(), 10)
+    q.push([5.5, True, 20, 21]) # 11 items in the heap, only 4 valid
+    assert_equal(q._total_len(), 4)
+    assert_equal(len(q), 4)
+    assert_equal([q.pop()[0] for _ in range(4)], [5.5, 7.0, 8.0, 9.0])
+
+
+class _CountingClassifier(object):
+    """Mock classifier scoring edges by their mean boundary value."""
+    def __init__(self):
+        self.ncalls = 0
+
+    def predict_proba(self, features):
+        self.ncalls += 1
+        p = np.reshape(features, (-1, 1))
+        return np.hstack((1 - p, p))
+
+
+def test_batch_classifier_probability():
+    i = 1
+    cl = _CountingClassifier()
+    mpf = agglo.classifier_probability(agglo.boundary_mean, cl)
+    g1, g2 = [agglo.Rag(wss[i], probs[i], f, normalize_probabilities=True)
+              for f in [mpf, agglo.boundary_mean]]
+    edges = g1.real_edges()
+    assert_allclose(mpf.batch(g1, edges), [mpf(g1, *e) for e in edges])
+    cl.ncalls = 0
+    g1.rebuild_merge_queue()
+    assert_equal(cl.ncalls, 1)
+    num_nodes = g1.number_of_nodes()
+    for g in [g1, g2]:
+        g.agglomerate(0.5)
+    assert g1.number_of_nodes() < num_nodes
+    assert_equal(g1.get_segmentation(), g2.get_segmentation())
+
+
+def test_deferred_rescoring():
+    i = 3
+    cl = _CountingClassifier()
+    mpf = agglo.classifier_probability(agglo.boundary_mean, cl)
+    g = agglo.Rag(wss[i], probs[i], mpf, normalize_probabilities=True)
+    g.rebuild_merge_queue()
+    while len(g.merge_queue) > 0:
+        cl.ncalls = 0
+        _, _, n1, n2 = g.merge_queue.pop()
+        g.merge_nodes(n1, n2)
+        assert cl.ncalls <= 1
+        assert g.dirty_edges is None
+
+
+def test_feature_vector_cache():
+    i = 3
+    fm = features.moments.Manager()
+    g = agglo.Rag(wss[i], probs[i], feature_manager=fm)
+    edges = g.real_edges()
+    f1 = [g.edge_features(fm, *e) for e in edges]
+    f2 = [g.edge_features(fm, *e) for e in edges]
+    assert_allclose(f1, f2)
+    assert_allclose(f1, [fm(g, *e) for e in edges])
+    stats = g.feature_vector_cache.stats()
+    assert_equal((stats['hits'], stats['misses']), (len(edges), len(edges)))
+    n1, n2 = edges[0]
+    g.merge_nodes(n1, n2)
+    assert all(n1 not in e and n2 not in e
+               for e in g.feature_vector_cache.row_of)
+    gm = features.graph.Manager()
+    g.edge_features(gm, *g.real_edges()[0])
+    g.edge_features(gm, *g.real_edges()[0])
+    assert_equal(g.feature_vector_cache.stats()['hits'], len(edges))
+
+
+def _cached_feature_priority(fm):
+    """Return a merge priority function reading cached feature vectors."""
+    def mpf(g, n1, n2):
+        return g.edge_features(fm, n1, n2)[0]
+    return mpf
+
+
+def test_rollback_feature_vector_cache():
+    fm = features.moments.Manager()
+    for i in [2, 3, 5]:
+        g = agglo.Rag(wss[i], probs[i], _cached_feature_priority(fm),
+                      feature_manager=fm)
+        for n1, n2 in g.real_edges():
+            g.begin()
+            g.merge_nodes(n1, n2)
+            g.rollback()
+            for u, v in g.real_edges():
+                assert_allclose(g.edge_features(fm, u, v), fm(g, u, v))
+
+
+def test_lazy_feature_caches():
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    for i in range(len(wss)):
+        g1, g2 = [agglo.Rag(wss[i], probs[i], feature_manager=fm,
+                            lazy_feature_caches=lazy) for lazy in [False, True]]
+        assert not any('feature-cache' in g2.node[n] for n in g2.nodes())
+        # materialize some caches, then merge both kinds of nodes
+        for n1, n2 in g2.real_edges()[::2]:
+            fm(g2, n1, n2)
+        for g in [g1, g2]:
+            g.agglomerate(0.5)
+        assert_equal(g1.edges(), g2.edges())
+        for n1, n2 in g1.real_edges():
+            assert_allclose(fm(g1, n1, n2), fm(g2, n1, n2))
+
+
+def test_neighbor_modes():
+    for ws in wss:
+        for connectivity in range(1, ws.ndim + 1):
+            g1, g2, g3 = [agglo.Rag(ws, lowmem=lowmem,
+                                    connectivity=connectivity)
+                          for lowmem in [False, True, 'strides']]
+            idxs = np.arange(ws.ndim, g1.watershed.size - ws.ndim,
+                             dtype=np.uint32)
+            expected = g1.neighbor_idxs(idxs)
+            assert_equal(g2.neighbor_idxs(idxs), expected)
+            assert_equal(g3.neighbor_idxs(idxs), expected)
+            assert_equal(g3.neighbor_idxs(idxs[-1]), expected[-1])
+            assert_equal(g3.edges(), g1.edges())
+
+
+def test_save_load(tmpdir):
+    fn = str(tmpdir.join('rag.h5'))
+    fm = features.base.Composite(children=[features.moments.Manager(),
+                                           features.histogram.Manager()])
+    for i in range(len(wss)):
+        for backend, mmap in [('set', False), ('array', True)]:
+            g = agglo.Rag(wss[i], probs[i], feature_manager=fm,
+                          boundary_backend=backend)
+            g.agglomerate(0.3)
+            g.save(fn)
+            h = agglo.Rag.load(fn, feature_manager=fm, mmap=mmap)
+            assert_equal(sorted(h.edges()), sorted(g.edges()))
+            for n1, n2 in g.real_edges():
+                assert_equal(sorted(h[n1][n2]['boundary']),
+                             sorted(g[n1][n2]['boundary']))
+                assert_allclose(fm(h, n1, n2), fm(g, n1, n2))
+            for graph in [g, h]:
+                graph.agglomerate(0.6)
+            assert_equal(h.get_segmentation(), g.get_segmentation())
+            assert_equal(h.ucm, g.ucm)
+
+
+def test_snapshot_restore():
+    fm = features.moments.Manager()
+    for i in range(len(wss)):
+        for queue_type in ['lazy', 'indexed']:
+            g1, g2 = [agglo.Rag(wss[i], probs[i], feature_manager=fm,
+                                merge_queue_type=queue_type)
+                      for _ in range(2)]
+            g1.agglomerate(0.3)
+            g2.agglomerate(0.3)
+            snapshot = g2.snapshot()
+            g2.agglomerate(0.5)
+            g2.rebuild_merge_queue()
+            g2.agglomerate(0.7)
+            g2.restore(snapshot)
+            assert g2.undo_log is None
+            assert_equal(sorted(map(sorted, g2.edges())),
+                         sorted(map(sorted, g1.edges())))
+            for n1, n2 in g1.real_edges():
+                assert_equal(sorted(g2[n1][n2]['boundary']),
+                             sorted(g1[n1][n2]['boundary']))
+                assert_allclose(fm(g2, n1, n2), fm(g1, n1, n2))
+            assert_equal(g2.ucm, g1.ucm)
+            for g in [g1, g2]:
+                g.agglomerate(0.7)
+            assert_equal(g2.get_segmentation(), g1.get_segmentation())
+
+
+def test_transactions():
+    for queue_type in ['lazy', 'indexed']:
+        g1, g2 = [agglo.Rag(wss[5], probs[5], merge_queue_type=queue_type)
+                  for _ in range(2)]
+        g1.agglomerate(0.3)
+        g2.agglomerate(0.3)
+        g2.begin()
+        g2.merge_nodes(3, 4)
+        g2.begin()
+        g2.agglomerate(np.inf)
+        g2.commit()
+        assert_equal(g2.number_of_nodes(), 2)
+        g2.rollback()
+        assert g2.undo_log is None
+        assert_equal(sorted(g2.nodes()), sorted(g1.nodes()))
+        for g in [g1, g2]:
+            g.agglomerate(0.7)
+        assert_equal(g2.get_segmentation(), g1.get_segmentation())
+        assert_raises(ValueError, g2.rollback)
+    # score the neighbours of a tentative merge, then undo it
+    fm = features.moments.Manager()
+    mpf = _cached_feature_priority(fm)
+    g = agglo.Rag(wss[3], probs[3], mpf, feature_manager=fm)
+    edges = g.real_edges()
+    before = [mpf(g, u, v) for u, v in edges]
+    g.begin()
+    node_id = g.merge_nodes(*edges[0])
+    for n in g.neighbors(node_id):
+        if n != g.boundary_body:
+            assert_allclose(mpf(g, node_id, n), fm(g, node_id, n)[0])
+    g.rollback()
+    assert_allclose([mpf(g, u, v) for u, v in edges], before)
+    assert_allclose(before, [fm(g, u, v)[0] for u, v in edges])
+
+
+def test_segment_map():
+    for i in [3, 5]:
+        g = agglo.Rag(wss[i], probs[i])
+        g.agglomerate(0.3)
+        assert_equal(g.segment_map.get_map(), g.tree.get_map())
+        s = g.snapshot()
+        g.agglomerate(0.7)
+        assert_equal(g.segment_map.get_map(), g.tree.get_map())
+        g.restore(s)
+        assert_equal(g.segment_map.get_map(), g.tree.get_map())
+
+
+def test_ucm_modes():
+    for i in [1, 5]:
+        g1, g2, g3 = [agglo.Rag(wss[i], probs[i], ucm_mode=mode,
+                                normalize_probabilities=True)
+                      for mode in ['eager', 'deferred', 'off']]
+        num_nodes = g1.number_of_nodes()
+        for g in [g1, g2, g3]:
+            g.agglomerate(0.5)
+        assert g1.number_of_nodes() < num_nodes
+        assert g2.ucm_log
+        assert_equal(g2.get_ucm(), g1.get_ucm())
+        assert g2.ucm_log == []
+        s1, s2 = g1.snapshot(), g2.snapshot()
+        g1.agglomerate(np.inf)
+        g2.agglomerate(np.inf)
+        assert_equal(g2.get_ucm(), g1.get_ucm())
+        g1.restore(s1)
+        g2.restore(s2)
+        assert_equal(g2.get_ucm(), g1.get_ucm())
+        assert_equal(g3.get_segmentation(), g1.get_segmentation())
+        assert_raises(ValueError, g3.get_ucm)
+
+
+def test_agglomerate_sweep():
+    for i in [1, 3]:
+        g1, g2 = [agglo.Rag(wss[i], probs[i], normalize_probabilities=True)
+                  for _ in range(2)]
+        num_nodes = g1.number_of_nodes()
+        inner = wss[i] != 0
+        for t, sp_to_body in g1.agglomerate_sweep([0.7, 0.3, 0.5]):
+            g2.agglomerate(t)
+            assert_equal(g1.number_of_nodes(), g2.number_of_nodes())
+            seg = imio.apply_segmentation_map(wss[i], sp_to_body)
+            assert_allclose(ev.vi(seg[inner], g2.get_segmentation()[inner]),
+                            0.0, atol=1e-8)
+        assert g1.number_of_nodes() < num_nodes
+
+
+def test_best_possible_segmentation():
+    for i in [1, 3]:
+        ws, gt = wss[i], results[i].astype(int)
+        cnt = agglo.contingency_table(ws, gt)
+        assignment = cnt == cnt.max(axis=1)[:, np.newaxis]
+        assignment[assignment.sum(axis=1) > 1, :] = 0
+        g = agglo.Rag(ws)
+        for gt_node in range(1, cnt.shape[1]):
+            g.merge_subgraph(np.flatnonzero(assignment[:, gt_node]))
+        assert_equal(agglo.best_possible_segmentation(ws, gt),
+                     g.get_segmentation())
+
+
+def test_split_vi_history(tmpdir):
+    i = 1
+    gt = results[i].astype(int)
+    # the RIG ignores watershed boundaries, which get_segmentation fills
+    inner = wss[i] != 0
+    def segmentation(g):
+        return g.get_segmentation() * inner
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean, gt_vol=gt,
+                  normalize_probabilities=True)
+    num_nodes = g.number_of_nodes()
+    g.agglomerate(0.5)
+    assert g.number_of_nodes() < num_nodes
+    expected = ev.split_vi(segmentation(g), gt)
+    assert_allclose(g.split_vi(), expected, atol=1e-10)
+    ctable = ev.contingency_table(segmentation(g), gt).toarray()
+    assert_allclose(g.rig.todense(ctable.shape), ctable)
+    g.begin()
+    _, _, evaluation = g.agglomerate(np.inf, save_history=True)
+    assert len(evaluation) > 0
+    assert_allclose(evaluation[-1][1],
+                    ev.split_vi(segmentation(g), gt), atol=1e-10)
+    merged = ev.contingency_table(segmentation(g), gt).toarray()
+    assert_allclose(g.rig.todense(merged.shape), merged)
+    g.rollback()
+    assert_allclose(g.split_vi(), expected, atol=1e-10)
+    assert_allclose(g.rig.todense(ctable.shape), ctable)
+    fn = str(tmpdir.join('rag.h5'))
+    g.save(fn)
+    h = agglo.Rag.load(fn)
+    assert_allclose(h.split_vi(), expected, atol=1e-10)
+    assert_allclose(h.rig.todense(ctable.shape), ctable)
+    for graph in [g, h]:
+        graph.agglomerate(np.inf)
+    assert_allclose(h.split_vi(), g.split_vi(), atol=1e-10)
+    assert_equal(h.get_segmentation(), g.get_segmentation())
+
+
+def test_extent():
+    i = 5
+    g = agglo.Rag(wss[i], probs[i], agglo.boundary_mean,
+                  normalize_probabilities=True)
+    num_nodes = g.number_of_nodes()
+    g.agglomerate(0.5)
+    assert g.number_of_nodes() < num_nodes
+    for n in g.nodes():
+        if n != g.boundary_body:
+            expected = np.flatnonzero(np.in1d(g.watershed_r,
+                                              g.node[n]['watershed_ids']))
+            assert_equal(np.sort(g.extent(n)), expected)
+            assert_equal(len(expected), g.node[n]['size'])
+
+
 if __name__ == '__main__':
     from numpy import testing
     testing.run_module_suite()
@@ -114,6 +114,34 @@ def test_2channel_composite_feature():
                     'toy-data/test-04-composite-2channel-12-13.pck'), 2)
 
 
+def test_bulk_histogram_caches():
+    f = features.histogram.Manager(4)
+    p = np.round(probs2 * 4) / 4 # many values on the bin edges
+    g = agglo.Rag(wss1, p, feature_manager=f)
+    ar = g.non_oriented_probabilities_r
+    for n in g.nodes():
+        if n != g.boundary_body:
+            idxs = np.flatnonzero(g.watershed_r == n)
+            assert_equal(g.node[n]['feature-cache'], f.histogram(ar[idxs]))
+    for n1, n2 in g.edges():
+        assert_equal(g[n1][n2]['feature-cache'],
+                     f.create_edge_cache(g, n1, n2))
+
+
+def test_bulk_moment_caches():
+    f = features.moments.Manager(4)
+    g = agglo.Rag(wss1, probs2, feature_manager=f)
+    ar = g.non_oriented_probabilities_r
+    for n in g.nodes():
+        if n != g.boundary_body:
+            idxs = np.flatnonzero(g.watershed_r == n)
+            assert_allclose(g.node[n]['feature-cache'],
+                            f.compute_moment_sums(ar, idxs))
+    for n1, n2 in g.edges():
+        assert_allclose(g[n1][n2]['feature-cache'],
+                        f.create_edge_cache(g, n1, n2))
+
+
 if __name__ == '__main__':
     from numpy import testing
     testing.run_module_suite()
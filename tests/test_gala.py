@@ -184,6 +184,37 @@ def test_split_vi():
     assert_allclose(result, expected, atol=1e-6)
 
 
+def test_contingency_table_chunks():
+    cont = ev.contingency_table(ws_test, gt_test, norm=False)
+    cont_chunked = ev.contingency_table(ws_test, gt_test, norm=False,
+                                        chunk_size=1000)
+    assert_array_equal(cont_chunked.toarray(), cont.toarray())
+    assert_allclose(cont.sum(), np.sum((ws_test != 0) & (gt_test != 0)))
+
+
+def test_evaluate_h5():
+    measures = ev.evaluate_h5(test_list[3], test_list[0], chunk_size=7)
+    assert_allclose(measures['split_vi'], ev.split_vi(ws_test, gt_test))
+    assert_allclose(measures['rand_index'], ev.rand_index(ws_test, gt_test))
+    assert_allclose(measures['adapted_rand_error'],
+                    ev.adapted_rand_error(ws_test, gt_test))
+
+
+def test_vi_by_threshold():
+    from scipy.ndimage import label
+    ucm = np.round(pr_test[:, :, :4] * 10) / 10
+    gt = gt_test[:, :, :4]
+    result = ev.vi_by_threshold(ucm, gt, [0], [0])
+    expected = np.array([ev.split_vi(label(ucm < t)[0], gt)
+                         for t in result[0]]).T
+    assert_allclose(result[1:], expected, atol=1e-10)
+    result = ev.rand_by_threshold(ucm, gt)
+    expected = np.array([[ev.rand_index(label(ucm < t)[0], gt),
+                          ev.adj_rand_index(label(ucm < t)[0], gt)]
+                         for t in result[0]]).T
+    assert_allclose(result[1:], expected, atol=1e-10)
+
+
 if __name__ == '__main__':
     np.random.RandomState(0)
     from numpy import testing
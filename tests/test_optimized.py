@@ -60,6 +60,22 @@ def test_flood_fill_pipes():
     assert_equal(len(t8), (example3==6).sum(), fail_message)
 
 
+def test_flood_fill_nd_connectivity():
+    fail_message = 'Flood fill failed in 2D with full connectivity.'
+    im = np.array([[1,0,0],
+                   [0,1,0],
+                   [0,0,2]])
+    t1 = opt.flood_fill(im, (0,0), [1], None, True)
+    assert_equal(set(t1), set([0]), fail_message)
+    t2 = opt.flood_fill(im, (0,0), [1,2], None, True, connectivity=2)
+    assert_equal(set(t2), set([0,4,8]), fail_message)
+    t3 = opt.flood_fill(im, (0,0), [1,2], [[0,1],[0,1]], True, connectivity=2)
+    assert_equal(set(t3), set([0,4]), fail_message)
+    im4 = np.zeros((3,3,3,3), int)
+    t4 = opt.flood_fill(im4, (1,1,1,1), [0], None, True)
+    assert_equal(len(t4), 81, fail_message)
+
+
 def _despeckle_example():
     example = np.array( [[3,3,3,3,0,0,0,0,0,4,4,4,4,0,0,0,0,0,0,0,0,0,-1,10],
                          [3,2,2,3,0,0,0,0,0,0,4,4,0,0,0,0,0,0,0,0,0,0,-1,10],